@@ -2,7 +2,8 @@ import os
 import math
 import secrets
 from datetime import datetime, timezone
-from flask import Flask, render_template, request, g
+from flask import Flask, render_template, request, url_for
+from markupsafe import Markup, escape
 from flask_cors import CORS
 from dotenv import load_dotenv
 from functions import salt_and_hash
@@ -14,8 +15,13 @@ from db import (
     insert_report,
     get_latest_feed_items,
     get_latest_feed_items_count,
+    get_latest_feed_items_refreshed_at,
     get_active_feeds_with_posts,
     get_inactive_feeds,
+    end_transactions,
+    search_feed_items,
+    SNIPPET_START,
+    SNIPPET_END,
 )
 
 
@@ -23,16 +29,21 @@ load_dotenv()
 
 CORS_ORIGIN = os.environ["CORS_ORIGIN"]
 
+# search results are ranked, every page ranks all the matches up to it
+MAX_SEARCH_PAGES = 25
+
+# largest id sqlite can store, bigger ones fail to bind
+MAX_ID = 2**63 - 1
+
 app = Flask(__name__)
 register_cli(app)
 CORS(app, origins=[CORS_ORIGIN])
 
 
 @app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+def end_request_transactions(exception):
+    # connections stay open for the next requests, see db.connection
+    end_transactions()
 
 
 @app.route("/report", methods=["POST"])
@@ -60,19 +71,57 @@ def report():
 @app.route("/", methods=["GET"])
 def index():
     per_page = 50
-    page = request.args.get("page", 1, type=int)
+    # pages are linked by cursors, the (published_at, feed_id) of the
+    # item they start after (or end before, going back), which is read
+    # straight from the index however deep the page is. page is only the
+    # number shown, carried along by the links
+    page = max(1, request.args.get("page", 1, type=int))
+    feed_id = request.args.get("id", type=int)
+    after = before = None
+    if feed_id is not None and valid_cursor(request.args.get("after"), feed_id):
+        after = (request.args["after"], feed_id)
+    elif feed_id is not None and valid_cursor(request.args.get("before"), feed_id):
+        before = (request.args["before"], feed_id)
+    else:
+        # no cursor, or one not made by our links: the first page
+        page = 1
 
-    if page < 1:
+    feed_items, more = get_latest_feed_items(
+        per_page=per_page, after=after, before=before
+    )
+    if before is not None and not more:
+        # back to the top, show a full first page
         page = 1
+        before = None
+        feed_items, more = get_latest_feed_items(per_page=per_page)
+
+    # read backwards, `more` says whether there are newer pages
+    has_previous = more if before is not None else after is not None
+    has_next = before is not None or more
+    previous_url = next_url = None
+    if feed_items and has_previous:
+        previous_url = url_for(
+            "index",
+            before=feed_items[0]["published_at"],
+            id=feed_items[0]["feed_id"],
+            page=page - 1,
+        )
+    if feed_items and has_next:
+        next_url = url_for(
+            "index",
+            after=feed_items[-1]["published_at"],
+            id=feed_items[-1]["feed_id"],
+            page=page + 1,
+        )
 
-    feed_items = get_latest_feed_items(per_page=per_page, page=page)
     total_items = get_latest_feed_items_count()
     total_pages = max(1, math.ceil(total_items / per_page))
     start_index = (page - 1) * per_page + 1
 
-    # Get last refresh timestamp from first feed item (all have the same value)
-    if feed_items:
-        last_updated = feed_items[0]["last_refreshed"]
+    # rows are refreshed as their feeds get new posts, the last one is
+    # when the page last changed
+    last_updated = get_latest_feed_items_refreshed_at()
+    if last_updated:
         # Parse the datetime string and ensure it's treated as UTC
         dt = datetime.fromisoformat(last_updated)
         if dt.tzinfo is None:
@@ -95,6 +144,8 @@ def index():
         feed_items=feed_items,
         current_page=page,
         total_pages=total_pages,
+        previous_url=previous_url,
+        next_url=next_url,
         start_index=start_index,
         last_updated=last_updated,
         last_updated_formatted=last_updated_formatted,
@@ -103,6 +154,61 @@ def index():
     )
 
 
+def valid_cursor(published_at, feed_id):
+    """Whether (published_at, feed_id) could come from a page link"""
+    if published_at is None or not 0 <= feed_id <= MAX_ID:
+        return False
+    try:
+        datetime.fromisoformat(published_at)
+    except ValueError:
+        return False
+    return True
+
+
+def highlight(snippet):
+    """Search snippet as html, its matches in <mark>"""
+    return (
+        escape(snippet)
+        .replace(SNIPPET_START, Markup("<mark>"))
+        .replace(SNIPPET_END, Markup("</mark>"))
+    )
+
+
+@app.route("/search", methods=["GET"])
+def search():
+    per_page = 20
+    text = request.args.get("q", "").strip()
+    page = request.args.get("page", 1, type=int)
+    page = min(max(page, 1), MAX_SEARCH_PAGES)
+
+    results, more = search_feed_items(text, per_page=per_page, page=page)
+    for_template = [
+        dict(result, snippet=highlight(result["snippet"] or "")) for result in results
+    ]
+    previous_url = url_for("search", q=text, page=page - 1) if page > 1 else None
+    next_url = None
+    if more and page < MAX_SEARCH_PAGES:
+        next_url = url_for("search", q=text, page=page + 1)
+
+    # Generate nonce for CSP
+    nonce = secrets.token_hex(16)
+
+    # Get backend URL for CSP
+    backend_url = os.environ.get("BACKEND_URL", request.host_url)
+
+    return render_template(
+        "views/search.html",
+        text=text,
+        results=for_template,
+        current_page=page,
+        start_index=(page - 1) * per_page + 1,
+        previous_url=previous_url,
+        next_url=next_url,
+        nonce=nonce,
+        backend_url=backend_url,
+    )
+
+
 @app.route("/about", methods=["GET"])
 def about():
     # Generate nonce for CSP
@@ -137,3 +243,22 @@ def sources():
         nonce=nonce,
         backend_url=backend_url,
     )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Only for scrapers holding METRICS_TOKEN, sent as a bearer token;
+    # without one set the route doesn't exist. Checking for a loopback
+    # client wouldn't hold behind a reverse proxy on the same host
+    token = os.environ.get("METRICS_TOKEN")
+    authorization = request.headers.get("Authorization", "").encode()
+    if not token or not secrets.compare_digest(
+        authorization, f"Bearer {token}".encode()
+    ):
+        return {"message": "Not found"}, 404
+    # Written by process-feeds, which runs in its own process
+    metrics_file = os.environ.get("METRICS_FILE")
+    if not metrics_file or not os.path.exists(metrics_file):
+        return {"message": "No metrics available"}, 404
+    with open(metrics_file) as f:
+        return f.read(), 200, {"Content-Type": "text/plain; version=0.0.4"}
@@ -0,0 +1,218 @@
+from db import (
+    expire_url_fetch_cache,
+    get_content_fetch_batch,
+    get_url_fetch_cache,
+    save_content_fetches,
+)
+from fetcher import (
+    fetch,
+    FetchError,
+    MAX_REDIRECTS,
+    POOL,
+    REDIRECT_STATUSES,
+    USER_AGENT,
+)
+from feed_processor import clean_content, log
+from bs4 import BeautifulSoup
+import threading
+import time
+from contextlib import contextmanager
+from email.message import Message
+from urllib import robotparser
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+# articles are single web pages, they need less room than whole feeds
+MAX_BYTES = 2 * 1024 * 1024
+ROBOTS_MAX_BYTES = 512 * 1024
+
+MAX_ATTEMPTS = 5
+
+# statuses after which retrying the same url is pointless
+GONE_STATUSES = (404, 410)
+
+# stored in url_fetch_cache.status for urls robots.txt doesn't let us fetch
+ROBOTS_DISALLOWED = -1
+
+# only final outcomes are cached, anything else is retried
+CACHED_STATUSES = (200, ROBOTS_DISALLOWED) + GONE_STATUSES
+
+# how long a cached download is reused, in days
+CACHE_DAYS = 30
+
+
+def header_charset(content_type):
+    """charset parameter of a Content-Type header, or None"""
+    message = Message()
+    message["content-type"] = content_type
+    return message.get_content_charset()
+
+
+def extract_article(html, encoding=None):
+    """Text of the page's <article> (or <main>, or <body>). `html` is the
+    page's bytes: decoded with `encoding` (from the Content-Type header)
+    when given and valid, otherwise as the page's <meta charset> says or
+    as detected, so latin-1 and windows-1252 pages come out right"""
+    soup = BeautifulSoup(html, "html.parser", from_encoding=encoding)
+    node = soup.find("article") or soup.find("main") or soup.body or soup
+    return clean_content(str(node))
+
+
+class HostThrottle:
+    """One request at a time per host, at least `delay` seconds apart.
+    Mirrors the scraper's CONCURRENT_REQUESTS_PER_DOMAIN and DOWNLOAD_DELAY"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    @contextmanager
+    def slot(self, url):
+        host = urlsplit(url).hostname or ""
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = [threading.Lock(), 0]
+            host_lock, _ = self.hosts[host]
+        with host_lock:
+            wait = self.hosts[host][1] + self.delay - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                yield
+            finally:
+                self.hosts[host][1] = time.monotonic()
+
+
+class RobotsCache:
+    """robots.txt of every host seen during a run, fetched once"""
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.origin_locks = {}
+        self.parsers = {}
+
+    def allowed(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self.lock:
+            if origin not in self.origin_locks:
+                self.origin_locks[origin] = threading.Lock()
+            origin_lock = self.origin_locks[origin]
+        with origin_lock:
+            if origin not in self.parsers:
+                self.parsers[origin] = self.load(origin)
+        return self.parsers[origin].can_fetch(USER_AGENT, url)
+
+    def load(self, origin):
+        parser = robotparser.RobotFileParser()
+        try:
+            with self.throttle.slot(origin):
+                response = fetch(
+                    f"{origin}/robots.txt", max_bytes=ROBOTS_MAX_BYTES, truncate=True
+                )
+        except FetchError:
+            # unreachable robots.txt: assume nothing is allowed, see RFC 9309
+            parser.disallow_all = True
+            return parser
+        if response.status >= 500:
+            parser.disallow_all = True
+        elif response.status >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.body.decode("utf-8", "replace").splitlines())
+        return parser
+
+
+class ContentBackfiller:
+    """Downloads the article of feed items whose feed had no content for
+    them, queued in content_fetch_queue by FeedProcessor's writes.
+
+    It runs apart from feed polling, in batches of `batch_size` items,
+    on `concurrency` threads, politely (robots.txt, one request at a
+    time per host, `delay` seconds apart). Downloads are cached per url
+    in url_fetch_cache, and failed items are retried with a backoff."""
+
+    def __init__(self, batch_size=50, concurrency=4, delay=1):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.throttle = HostThrottle(delay)
+        self.robots = RobotsCache(self.throttle)
+
+    def run(self, max_batches=None):
+        log("Starting content backfill", "INFO")
+        expired = expire_url_fetch_cache(CACHE_DAYS)
+        log(f"Expired {expired} cached downloads", "INFO")
+        batches = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while max_batches is None or batches < max_batches:
+                batch = get_content_fetch_batch(self.batch_size)
+                if not batch:
+                    break
+                self.process_batch(executor, batch)
+                batches += 1
+        POOL.close()
+        log(f"Content backfill finished after {batches} batches", "INFO")
+
+    def download(self, url):
+        """Runs on a worker thread; returns (status, content), status is
+        None if the request couldn't complete.
+
+        Redirects are followed here, each one only if robots.txt of the
+        host it leads to allows it, and throttled as a request to it"""
+        for _ in range(MAX_REDIRECTS + 1):
+            if not self.robots.allowed(url):
+                return ROBOTS_DISALLOWED, None
+            try:
+                with self.throttle.slot(url):
+                    response = fetch(
+                        url, max_bytes=MAX_BYTES, truncate=True, follow_redirects=False
+                    )
+            except FetchError as e:
+                log(f"    Couldn't download {url}: {e}", "ERROR")
+                return None, None
+            location = response.headers.get("location")
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            url = urljoin(url, location)
+        else:
+            log(f"    Couldn't download {url}: too many redirects", "ERROR")
+            return None, None
+        if response.status != 200:
+            return response.status, None
+        charset = header_charset(response.headers.get("content-type", ""))
+        return response.status, extract_article(response.body, charset)
+
+    def process_batch(self, executor, batch):
+        urls = list({row["url"] for row in batch})
+        results = {
+            url: (row["status"], row["content"])
+            for url, row in get_url_fetch_cache(urls, CACHE_DAYS).items()
+        }
+        to_fetch = [url for url in urls if url not in results]
+        log(
+            f"Backfilling {len(batch)} items, {len(urls) - len(to_fetch)} urls cached",
+            "INFO",
+        )
+
+        fetched = []
+        for url, result in zip(to_fetch, executor.map(self.download, to_fetch)):
+            results[url] = result
+            status, content = result
+            if status in CACHED_STATUSES:
+                fetched.append((url, status, content))
+
+        filled, retries, dropped = [], [], []
+        for row in batch:
+            status, content = results[row["url"]]
+            if status == 200 and content:
+                log(f"    {row['url']}", "INFO")
+                filled.append((content, row["feed_item_id"]))
+            elif status in CACHED_STATUSES or row["attempts"] + 1 >= MAX_ATTEMPTS:
+                dropped.append((row["feed_item_id"],))
+            else:
+                delay = f"+{2 ** row['attempts']} hours"
+                retries.append((delay, row["feed_item_id"]))
+
+        save_content_fetches(filled, retries, dropped, fetched)
@@ -0,0 +1,93 @@
+"""Compares html_text.html_to_text with the BeautifulSoup based
+clean_content it replaced, on real post bodies.
+
+Each argument is a feed (url or file, every entry's content is used) or
+an .html file. Outputs of both implementations are checked to match.
+
+    uv run python benchmarks/bench_clean_content.py https://example.com/feed.xml post.html
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import feedparser
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from html_text import html_to_text  # noqa: E402
+
+
+def soup_clean_content(html_content):
+    """clean_content as it was before html_text.py"""
+    soup = BeautifulSoup(html_content, "html.parser")
+    for script in soup(["script", "style"]):
+        script.extract()
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return " ".join(chunk for chunk in chunks if chunk)
+
+
+def load_corpus(sources):
+    bodies = []
+    for source in sources:
+        if source.endswith((".html", ".htm")):
+            with open(source, encoding="utf-8", errors="replace") as f:
+                bodies.append(f.read())
+            continue
+        parsed = feedparser.parse(source)
+        for entry in parsed.entries:
+            if "content" in entry:
+                bodies.append(entry.content[0].value)
+            elif "summary" in entry:
+                bodies.append(entry.summary)
+    return [body for body in bodies if body]
+
+
+def best_time(function, bodies, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            function(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="feed urls/files or .html files")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = load_corpus(args.sources)
+    if not bodies:
+        sys.exit("no post bodies found")
+    size = sum(len(body.encode("utf-8")) for body in bodies) / 1024 / 1024
+    print(f"{len(bodies)} bodies, {size:.2f} MB")
+
+    mismatches = sum(
+        1 for body in bodies if soup_clean_content(body) != html_to_text(body)
+    )
+    print(f"{mismatches} bodies with different output")
+
+    results = {}
+    for name, function in (
+        ("beautifulsoup", soup_clean_content),
+        ("html_text", html_to_text),
+    ):
+        results[name] = best_time(function, bodies, args.repeat)
+        print(
+            f"{name:>14}: {results[name] * 1000:8.1f} ms"
+            f"  {size / results[name]:6.2f} MB/s"
+            f"  {results[name] / len(bodies) * 1e6:8.1f} us/body"
+        )
+    print(f"speedup: {results['beautifulsoup'] / results['html_text']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
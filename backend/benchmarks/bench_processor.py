@@ -0,0 +1,371 @@
+"""Offline benchmark of FeedProcessor (what process-feeds runs).
+
+Starts a local http server serving synthetic RSS and Atom feeds, seeds a
+temporary database with --feeds feeds pointing at it and processes them
+all, then reports feeds/sec, per-feed latency percentiles (time spent in
+the phases timed by metrics.py), peak memory and database time.
+
+Which feeds answer slowly, fail or are big is drawn from --seed, so two
+runs with the same arguments process the same feeds and can be compared.
+With --runs above 1 the same feeds are processed again, which measures
+the conditional requests path (the server supports etags). With
+--revalidate the feeds' validators are forgotten between runs instead, so
+every feed is downloaded and parsed again and its entries looked up among
+the stored ones: any new entry after the first run is a duplicate, and
+the benchmark fails. --numeric-guid-rate of the RSS feeds use numbers as
+guids, which the database stores as integers.
+
+    uv run python benchmarks/bench_processor.py --feeds 500 --concurrency 16
+
+--hosts spreads the feeds over 127.0.0.1 to 127.0.0.N (Linux routes the
+whole 127/8 block to the loopback interface), otherwise they all share
+one host and --per-host defaults to --concurrency.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from urllib.parse import parse_qs, urlsplit
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod".split()
+
+
+def feed_body(feed_id, params):
+    """Synthetic feed, always the same for the same id and parameters"""
+    rng = random.Random(feed_id)
+    entries = int(params.get("entries", 20))
+    content_bytes = int(params.get("content", 2000))
+    atom = params.get("format") == "atom"
+    numeric_guids = params.get("guids") == "numeric"
+    newest = datetime(2026, 1, 1, tzinfo=timezone.utc) - timedelta(hours=feed_id)
+    base = f"https://blog{feed_id}.example"
+
+    items = []
+    for i in range(entries):
+        words = []
+        size = 0
+        while size < content_bytes:
+            word = rng.choice(WORDS)
+            words.append(f"<b>{word}</b>" if rng.random() < 0.05 else word)
+            size += len(words[-1]) + 1
+        content = f"<p>{' '.join(words)}</p><script>track({i})</script>"
+        published = newest - timedelta(hours=7 * i)
+        url = f"{base}/posts/{i}"
+        guid = (
+            f"<guid isPermaLink='false'>{feed_id * 10000 + i}</guid>"
+            if numeric_guids
+            else f"<guid>{url}</guid>"
+        )
+        if atom:
+            items.append(
+                f"<entry><title>Post {i}</title><link href='{url}'/>"
+                f"<id>{url}</id><published>{published.isoformat()}</published>"
+                f"<author><name>Author {feed_id}</name></author>"
+                f"<content type='html'><![CDATA[{content}]]></content></entry>"
+            )
+        else:
+            items.append(
+                f"<item><title>Post {i}</title><link>{url}</link>"
+                f"{guid}<pubDate>{format_datetime(published)}</pubDate>"
+                f"<author>author{feed_id}@example.com</author>"
+                f"<content:encoded><![CDATA[{content}]]></content:encoded></item>"
+            )
+
+    if atom:
+        return (
+            "<?xml version='1.0' encoding='utf-8'?>"
+            "<feed xmlns='http://www.w3.org/2005/Atom'>"
+            f"<title>Blog {feed_id}</title><id>{base}/</id>{''.join(items)}</feed>"
+        ).encode()
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>"
+        "<rss version='2.0' xmlns:content='http://purl.org/rss/1.0/modules/content/'>"
+        f"<channel><title>Blog {feed_id}</title><link>{base}/</link>"
+        f"{''.join(items)}</channel></rss>"
+    ).encode()
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    """GET /feed/<id>?format=rss|atom&entries=&content=&latency=&status=&slow=
+
+    latency: seconds before answering; status: answer this status
+    instead of the feed; slow: seconds the body takes to trickle in"""
+
+    protocol_version = "HTTP/1.1"
+    bodies = {}
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        time.sleep(float(params.get("latency", 0)))
+
+        status = int(params.get("status", 200))
+        if status != 200:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.path not in self.bodies:
+            feed_id = int(parts.path.rsplit("/", 1)[1])
+            self.bodies[self.path] = feed_body(feed_id, params)
+        body = self.bodies[self.path]
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        slow = float(params.get("slow", 0))
+        if not slow:
+            self.wfile.write(body)
+            return
+        pieces = 10
+        step = len(body) // pieces + 1
+        for start in range(0, len(body), step):
+            self.wfile.write(body[start : start + step])
+            self.wfile.flush()
+            time.sleep(slow / pieces)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(hosts, port, ready):
+    servers = []
+    for host in hosts:
+        server = http.server.ThreadingHTTPServer((host, port), FeedHandler)
+        server.daemon_threads = True
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.set()
+    threading.Event().wait()
+
+
+def feed_urls(args, port):
+    """Feed urls, with the behavior of each feed drawn from args.seed"""
+    rng = random.Random(args.seed)
+    # drawn apart, so the other behaviors stay the same as before
+    guid_rng = random.Random(args.seed + 1)
+    urls = []
+    for feed_id in range(args.feeds):
+        host = f"127.0.0.{feed_id % args.hosts + 1}"
+        if args.format == "mixed":
+            feed_format = "atom" if feed_id % 2 else "rss"
+        else:
+            feed_format = args.format
+        params = {
+            "format": feed_format,
+            "entries": args.entries,
+            "content": args.content_bytes,
+            "latency": args.latency,
+        }
+        draw = rng.random()
+        if draw < args.error_rate:
+            params["status"] = rng.choice([404, 500, 503])
+        elif draw < args.error_rate + args.slow_rate:
+            params["slow"] = args.slow_seconds
+        elif draw < args.error_rate + args.slow_rate + args.big_rate:
+            params["entries"] = args.big_entries
+        if feed_format == "rss" and guid_rng.random() < args.numeric_guid_rate:
+            params["guids"] = "numeric"
+        query = "&".join(f"{key}={value}" for key, value in params.items())
+        urls.append(f"http://{host}:{port}/feed/{feed_id}?{query}")
+    return urls
+
+
+def seed_database(path, urls):
+    con = sqlite3.connect(path)
+    with open(os.path.join(BACKEND_DIR, "schema.sql")) as f:
+        con.executescript(f.read())
+    con.executemany(
+        "INSERT INTO feeds (domain, feed_url, status_id) VALUES (?, ?, 1)",
+        [(f"blog{i}.example", url) for i, url in enumerate(urls)],
+    )
+    con.commit()
+    con.close()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile"""
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[max(0, round(p / 100 * len(values)) - 1)]
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def benchmark(args, urls):
+    # db.py reads DATABASE when imported, see main
+    from flask import Flask
+    from feed_processor import FeedProcessor
+    from metrics import Metrics, PHASES
+
+    class RecordingMetrics(Metrics):
+        """Also keeps every feed's total time, for percentiles"""
+
+        def __init__(self):
+            super().__init__()
+            self.feed_totals = []
+
+        def record(self, stats):
+            super().record(stats)
+            self.feed_totals.append(sum(stats.get(phase, 0) for phase in PHASES))
+
+    app = Flask(__name__)
+    results = []
+    for run in range(args.runs):
+        with app.app_context():
+            con = sqlite3.connect(os.environ["DATABASE"])
+            with con:
+                con.execute("UPDATE feeds SET next_check_at = NULL")
+                if args.revalidate:
+                    con.execute(
+                        "UPDATE feeds SET etag = NULL, modified = NULL, body_hash = NULL, entries_hash = NULL"
+                    )
+            con.close()
+
+            processor = FeedProcessor(
+                save_content=args.save_content,
+                num_feeds=len(urls),
+                concurrency=args.concurrency,
+                per_host=args.per_host or args.concurrency,
+                commit_every=args.commit_every,
+                parse_workers=args.parse_workers,
+            )
+            processor.metrics = RecordingMetrics()
+            output = sys.stdout if args.verbose else open(os.devnull, "w")
+            with contextlib.redirect_stdout(output):
+                started_at = time.monotonic()
+                processor.run()
+                elapsed = time.monotonic() - started_at
+
+        metrics = processor.metrics
+        totals = metrics.feed_totals
+        results.append(
+            {
+                "run": run + 1,
+                "feeds": len(totals),
+                "seconds": elapsed,
+                "feeds_per_second": len(totals) / elapsed,
+                "p50_seconds": percentile(totals, 50),
+                "p99_seconds": percentile(totals, 99),
+                "max_seconds": max(totals, default=0),
+                "db_seconds": metrics.phases["db"].sum,
+                "commit_seconds": metrics.flush_seconds.sum,
+                "new_entries": metrics.new_entries,
+                "outcomes": metrics.outcomes,
+                "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+                "peak_rss_parse_workers_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--feeds", type=int, default=200)
+    parser.add_argument("--format", choices=["rss", "atom", "mixed"], default="mixed")
+    parser.add_argument("--entries", type=int, default=20)
+    parser.add_argument("--content-bytes", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.02)
+    parser.add_argument("--slow-seconds", type=float, default=3)
+    parser.add_argument("--big-rate", type=float, default=0.01)
+    parser.add_argument("--big-entries", type=int, default=1000)
+    parser.add_argument("--numeric-guid-rate", type=float, default=0.1)
+    parser.add_argument("--hosts", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--per-host", type=int)
+    parser.add_argument("--commit-every", type=int, default=10)
+    parser.add_argument("--parse-workers", type=int)
+    parser.add_argument("--save-content", action="store_true")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--revalidate", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--verbose", action="store_true", help="show the processor log")
+    args = parser.parse_args()
+
+    hosts = [f"127.0.0.{i + 1}" for i in range(args.hosts)]
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve, args=(hosts, args.port, ready), daemon=True
+    )
+    server.start()
+    ready.wait()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE"] = os.path.join(tmp, "bench.sqlite3")
+        urls = feed_urls(args, args.port)
+        seed_database(os.environ["DATABASE"], urls)
+        try:
+            results = benchmark(args, urls)
+        finally:
+            server.terminate()
+
+    duplicates = sum(result["new_entries"] for result in results[1:])
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    if args.revalidate and duplicates:
+        sys.exit(f"{duplicates} entries counted as new again after the first run")
+
+
+def print_results(results):
+    for result in results:
+        outcomes = ", ".join(
+            f"{outcome} {count}"
+            for outcome, count in sorted(result["outcomes"].items())
+        )
+        print(
+            f"run {result['run']}: {result['feeds']} feeds in {result['seconds']:.2f}s"
+        )
+        print(f"  throughput   {result['feeds_per_second']:.1f} feeds/s")
+        print(
+            f"  per feed     p50 {result['p50_seconds'] * 1000:.1f} ms"
+            f", p99 {result['p99_seconds'] * 1000:.1f} ms"
+            f", max {result['max_seconds'] * 1000:.1f} ms"
+        )
+        print(
+            f"  database     {result['db_seconds']:.2f}s on the main thread"
+            f", {result['commit_seconds']:.2f}s committing"
+        )
+        print(
+            f"  peak rss     {result['peak_rss_mb']:.0f} MB"
+            f", parse workers {result['peak_rss_parse_workers_mb']:.0f} MB"
+        )
+        print(f"  outcomes     {outcomes}; {result['new_entries']} new entries")
+
+
+if __name__ == "__main__":
+    main()
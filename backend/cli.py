@@ -12,14 +12,32 @@ from db import (
     get_feed_by_domain,
     get_feed_by_url,
     get_stalest_feeds,
+    stalest_feeds_query,
+    latest_feed_items_query,
+    explain_query_plan,
     get_oldest_crawled_feed,
+    get_blocked_feeds_description,
+    blocked_feeds_query,
     update_feed_status,
     get_feeds,
     refresh_latest_posts,
+    resume_feeds,
+    search_feed_items,
+    rebuild_search_index,
+    get_content_sample,
+    add_content_dictionary,
+    compress_stored_content,
+    archive_content,
+    vacuum,
+    publish_snapshot,
+    SNIPPET_START,
+    SNIPPET_END,
 )
 import enum
 import pyperclip
 from feed_processor import FeedProcessor
+from backfill import ContentBackfiller
+from compression import build_dictionary, MAX_DICTIONARY_SIZE, MIN_DICTIONARY_SIZE
 
 
 class FeedStatus(enum.Enum):
@@ -223,7 +241,7 @@ def register_cli(app):
         update_feed_status(feed_obj["id"], feed_status.value)
         feed_obj = get_feed_by_domain(domain)
         new_status = feed_obj["feed_status"]
-        insert_feed_history(feed_obj["id"], feed_obj["status_id"], descr)
+        insert_feed_history(feed_obj["id"], feed_obj["status_id"], descr.value)
         print(f"Updated {domain} from {old_status} to {new_status}")
 
     @app.cli.command("crawl-feeds")
@@ -258,6 +276,170 @@ def register_cli(app):
         if mark_crawled:
             batch_update_crawled_at([(feed["id"],) for feed in feeds])
 
+    @app.cli.command("check-query-plans")
+    def check_query_plans():
+        """Fails if a query that has to stay fast as the database grows
+        would scan a whole table or sort all of its rows.
+
+        The queries are explained on the current database, run it after
+        schema changes."""
+        queries = {
+            "crawl-feeds --limit": stalest_feeds_query(100, [1]),
+            "crawl-feeds --limit --include-crawled": stalest_feeds_query(100, [1, 2]),
+            "blocked-report": blocked_feeds_query(),
+            "blocked-report --reason": blocked_feeds_query("lang_detect_other"),
+            "index page": latest_feed_items_query(51),
+            "index page, next": latest_feed_items_query(
+                51, after=("2000-01-01T00:00:00", 1)
+            ),
+            "index page, previous": latest_feed_items_query(
+                51, before=("2000-01-01T00:00:00", 1)
+            ),
+        }
+        failed = []
+        for name, (query, params) in queries.items():
+            print(name)
+            for step in explain_query_plan(query, params):
+                # SCAN without an index: every row of the table is read,
+                # TEMP B-TREE: every matching row is read to be sorted.
+                # Scanning an index in order stops at the LIMIT
+                slow = (
+                    step.startswith("SCAN") and "INDEX" not in step
+                ) or "TEMP B-TREE" in step
+                print(f"    {step}{'  <- full scan' if slow else ''}")
+                if slow and name not in failed:
+                    failed.append(name)
+        if failed:
+            raise click.ClickException(f"Full scans in: {', '.join(failed)}")
+
+    @app.cli.command("search")
+    @click.argument("text")
+    @click.option("--page", default=1, show_default=True, type=int)
+    @click.option("--per-page", default=20, show_default=True, type=int)
+    def search(text, page, per_page):
+        """Searches the title and content of posts, best matches first"""
+        items, more = search_feed_items(text, per_page=per_page, page=page)
+        for position, item in enumerate(items, start=(page - 1) * per_page + 1):
+            print(
+                f"{position}. {item['title']} ({item['feed_domain']}, {item['published_at'][:10]})"
+            )
+            print(f"   {item['url']}")
+            if item["snippet"]:
+                snippet = (
+                    item["snippet"]
+                    .replace(SNIPPET_START, "[")
+                    .replace(SNIPPET_END, "]")
+                )
+                print(f"   {snippet}")
+        if more:
+            print(f"More results with --page {page + 1}")
+
+    @app.cli.command("blocked-report")
+    @click.option("--reason", type=click.Choice(FeedBlockedDescr, case_sensitive=False))
+    @click.option("--output")
+    def blocked_report(reason, output):
+        """Lists blocked feeds by the reason they were blocked for, most
+        recent first, to audit the language detection and LLM classifier
+        decisions.
+
+        --output writes the feeds to a .jsonl file instead."""
+        feeds = get_blocked_feeds_description(
+            reason.value if reason is not None else None
+        )
+        if output:
+            with jsonlines.open(output, "w") as writer:
+                writer.write_all(dict(feed) for feed in feeds)
+            return
+        current = object()
+        for feed in feeds:
+            if feed["descr"] != current:
+                current = feed["descr"]
+                print(f"{current or 'no reason'}:")
+            print(
+                f"    {feed['status_changed_at']}  {feed['domain']}  {feed['feed_url']}"
+            )
+        print(f"{len(feeds)} blocked feeds")
+
+    @app.cli.command("publish-snapshot")
+    @click.option(
+        "--output", envvar="SNAPSHOT_DATABASE", required=True, type=click.Path()
+    )
+    def publish_snapshot_command(output):
+        """Publishes what the web pages show to a read-only database at
+        --output (or SNAPSHOT_DATABASE), replacing the previous one.
+
+        When SNAPSHOT_DATABASE is set, the web app reads the latest posts
+        and sources from it, so crawling never slows pages down; run this
+        after process-feeds to update the site. Search and reports still
+        use DATABASE."""
+        publish_snapshot(output)
+
+    @app.cli.command("rebuild-search-index")
+    def rebuild_search_index_command():
+        """Indexes every post again for search, after schema changes or
+        when the index went out of sync"""
+        rebuild_search_index()
+
+    @app.cli.command("build-content-dictionary")
+    @click.option("--sample", default=2000, show_default=True, type=int)
+    @click.option("--size", default=MAX_DICTIONARY_SIZE, show_default=True, type=int)
+    def build_content_dictionary(sample, size):
+        """Builds a compression dictionary from the --sample most recent
+        posts. New posts are compressed with it, by processes started after
+        this; run compress-content to compress older ones (only those
+        stored as plain text are)."""
+        texts = get_content_sample(sample)
+        if not texts:
+            print("No posts with content to build a dictionary from.")
+            return
+        data = build_dictionary(texts, size)
+        if len(data) < MIN_DICTIONARY_SIZE:
+            print(
+                f"Not enough text repeated across {len(texts)} posts: the dictionary would be {len(data)} bytes, not storing it."
+            )
+            return
+        dictionary_id = add_content_dictionary(data)
+        print(f"Dictionary {dictionary_id}: {len(data)} bytes from {len(texts)} posts")
+
+    @app.cli.command("compress-content")
+    @click.option("--batch-size", default=1000, show_default=True, type=int)
+    @click.option("--vacuum", "run_vacuum", is_flag=True)
+    def compress_content_command(batch_size, run_vacuum):
+        """Compresses the content of posts stored before content was
+        compressed.
+
+        --vacuum shrinks the database file afterwards; until then the space
+        freed is only reused by new writes."""
+        compressed = compress_stored_content(batch_size)
+        print(f"Compressed the content of {compressed} posts")
+        if run_vacuum:
+            vacuum()
+
+    @app.cli.command("archive")
+    @click.option("--months", required=True, type=int)
+    @click.option(
+        "--archive-database",
+        envvar="ARCHIVE_DATABASE",
+        required=True,
+        type=click.Path(),
+    )
+    @click.option("--batch-size", default=1000, show_default=True, type=int)
+    @click.option("--vacuum", "run_vacuum", is_flag=True)
+    def archive(months, archive_database, batch_size, run_vacuum):
+        """Moves the content of posts published more than --months months
+        ago to --archive-database (or ARCHIVE_DATABASE), created if needed,
+        in its feed_item_contents table.
+
+        The posts themselves stay, without content: they are still listed
+        and found by title, and aren't downloaded again.
+
+        --vacuum shrinks the database file afterwards; until then the space
+        freed is only reused by new writes."""
+        archived = archive_content(archive_database, months, batch_size)
+        print(f"Archived the content of {archived} posts")
+        if run_vacuum:
+            vacuum()
+
     @app.cli.command("known-domains")
     @click.option("--output")
     def known_domains(output):
@@ -289,13 +471,98 @@ def register_cli(app):
                     continue
 
     @app.cli.command("process-feeds")
-    def process_feeds():
-        """Gets latest posts from feeds registered to the database"""
-        processor = FeedProcessor()
-        processor.run()
+    @click.option("--num-feeds", default=25, show_default=True, type=int)
+    @click.option("--concurrency", default=1, show_default=True, type=int)
+    @click.option("--per-host", default=2, show_default=True, type=int)
+    @click.option("--commit-every", default=1, show_default=True, type=int)
+    @click.option("--parse-workers", type=int)
+    @click.option("--max-entries", default=200, show_default=True, type=int)
+    @click.option("--save-content", is_flag=True)
+    @click.option("--daemon", is_flag=True)
+    @click.option("--metrics-file", envvar="METRICS_FILE", type=click.Path())
+    @click.option("--worker-id")
+    def process_feeds(
+        num_feeds,
+        concurrency,
+        per_host,
+        commit_every,
+        parse_workers,
+        max_entries,
+        save_content,
+        daemon,
+        metrics_file,
+        worker_id,
+    ):
+        """Gets latest posts from feeds registered to the database
+
+        --concurrency is how many feeds are downloaded at the same time.
+
+        --per-host caps simultaneous downloads from a single host.
+
+        --commit-every is how many processed feeds are grouped in one transaction.
+
+        --parse-workers is the size of the feed parsing process pool
+        (defaults to the number of cpus).
+
+        --max-entries caps how many entries of a single feed are read.
+
+        --save-content stores the text of posts too, for search; posts
+        whose feed has none are queued for backfill-content.
+
+        --daemon keeps running, processing each feed when it is due,
+        until it receives SIGTERM.
+
+        --metrics-file (or METRICS_FILE) is where timing histograms are
+        written in the Prometheus text format, at the end of a run or
+        periodically in daemon mode.
+
+        --worker-id names this processor in the feeds it claims (defaults
+        to hostname:pid); several processors can run at the same time."""
+        processor = FeedProcessor(
+            save_content=save_content,
+            num_feeds=num_feeds,
+            concurrency=concurrency,
+            per_host=per_host,
+            commit_every=commit_every,
+            parse_workers=parse_workers,
+            max_entries=max_entries,
+            metrics_file=metrics_file,
+            worker_id=worker_id,
+        )
+        if daemon:
+            processor.serve()
+        else:
+            processor.run()
+
+    @app.cli.command("resume-feeds")
+    @click.option("--domain")
+    def resume_feeds_processing(domain):
+        """Resumes processing of paused feeds (all of them, or the one of
+        --domain). Feeds are paused after failing for about two weeks in a
+        row, or when they answer 410 Gone."""
+        resumed = resume_feeds(domain)
+        print(f"Resumed {resumed} feeds")
+
+    @app.cli.command("backfill-content")
+    @click.option("--batch-size", default=50, show_default=True, type=int)
+    @click.option("--concurrency", default=4, show_default=True, type=int)
+    @click.option("--delay", default=1.0, show_default=True, type=float)
+    @click.option("--max-batches", type=int)
+    def backfill_content(batch_size, concurrency, delay, max_batches):
+        """Downloads the article text of posts whose feed had no content.
+
+        Posts are queued by process-feeds --save-content; --delay is the minimum number of
+        seconds between two requests to the same host."""
+        backfiller = ContentBackfiller(
+            batch_size=batch_size, concurrency=concurrency, delay=delay
+        )
+        backfiller.run(max_batches=max_batches)
 
     @app.cli.command("refresh-latest-posts")
     def refresh_latest_posts_cache():
-        """Updates the materialized view table with the latest feed_item
-        from each registered feed"""
+        """Rebuilds the materialized view table with the latest feed_item
+        from each registered feed.
+
+        process-feeds keeps the table up to date, this is a repair for when
+        it went out of sync (posts deleted or edited by hand...)"""
         refresh_latest_posts()
@@ -0,0 +1,89 @@
+"""Compression of the post text stored in feed_items.content.
+
+Posts are compressed one by one with raw deflate (zlib), optionally with
+a shared dictionary of words and phrases common in posts, which is what
+makes short texts compress well. Dictionaries are stored in the database
+(content_dictionaries) and never change, compressed posts name the one
+they need. Text stored before compression was added is left as is and
+read back unchanged."""
+
+import struct
+import zlib
+from collections import Counter
+
+LEVEL = 6
+WBITS = -15  # raw deflate, no zlib header and checksum
+
+# first byte of a compressed post; WITH_DICTIONARY is followed by the
+# dictionary id
+NO_DICTIONARY = b"\x00"
+WITH_DICTIONARY = b"\x01"
+DICTIONARY_ID = struct.Struct(">I")
+
+# zlib only looks this far back, larger dictionaries are wasted
+MAX_DICTIONARY_SIZE = 32 * 1024
+# smaller ones barely help, and every later post would name them
+MIN_DICTIONARY_SIZE = 1024
+
+
+def compress(text, dictionary=None):
+    """`dictionary` is (id, data) or None. None and empty text are kept
+    as they are: they mean no content and content still to download"""
+    if not text:
+        return text
+    if dictionary is None:
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS)
+        header = NO_DICTIONARY
+    else:
+        dictionary_id, data = dictionary
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, zdict=data)
+        header = WITH_DICTIONARY + DICTIONARY_ID.pack(dictionary_id)
+    return header + compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+
+def dictionary_id(value):
+    """Id of the dictionary `value` was compressed with, or None"""
+    if isinstance(value, bytes) and value[:1] == WITH_DICTIONARY:
+        return DICTIONARY_ID.unpack_from(value, 1)[0]
+    return None
+
+
+def decompress(value, dictionaries):
+    """Text of `value`, compressed or not; `dictionaries` is {id: data}"""
+    if not isinstance(value, bytes):
+        return value
+    if value[:1] == NO_DICTIONARY:
+        decompressor = zlib.decompressobj(WBITS)
+        data = value[1:]
+    else:
+        zdict = dictionaries[dictionary_id(value)]
+        decompressor = zlib.decompressobj(WBITS, zdict=zdict)
+        data = value[1 + DICTIONARY_ID.size :]
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+def build_dictionary(texts, size=MAX_DICTIONARY_SIZE):
+    """Dictionary of the words and two word phrases that would save the
+    most bytes in `texts`. zlib finds nearby matches with shorter codes,
+    so the most valuable ones go last"""
+    counts = Counter()
+    for text in texts:
+        words = text.split()
+        counts.update(words)
+        counts.update(" ".join(pair) for pair in zip(words, words[1:]))
+    # a string occurring once in a single text is never matched
+    scored = [
+        (count * len(string), string) for string, count in counts.items() if count > 1
+    ]
+    scored.sort(reverse=True)
+
+    chosen = []
+    used = 0
+    for _, string in scored:
+        length = len(string.encode("utf-8")) + 1
+        if used + length > size:
+            continue
+        chosen.append(string)
+        used += length
+    chosen.reverse()
+    return " ".join(chosen).encode("utf-8")[-size:]
@@ -1,21 +1,171 @@
-from flask import g
 import sqlite3
 import os
-from datetime import datetime, timedelta
+import json
+import threading
+import time
+from urllib.parse import quote
+
+import compression
 
 DATABASE = os.environ["DATABASE"]
 
+# read-only copy of what the site shows, made by publish_snapshot. When
+# set, the web pages read it instead of DATABASE (see query_site)
+SNAPSHOT_DATABASE = os.environ.get("SNAPSHOT_DATABASE")
+
+# applied to every connection. In WAL mode readers and the writer don't
+# block each other, and NORMAL sync is still safe from corruption with it
+PRAGMAS = (
+    ("busy_timeout", 5000),  # ms
+    ("synchronous", "NORMAL"),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -32 * 1024),  # KiB
+)
+CACHED_STATEMENTS = 256
+
+# connections of the current thread, by role, see connection()
+local = threading.local()
+
+# content_dictionaries rows, {id: data}, read once per process (and again
+# when a post needs a newer one), see get_dictionaries
+dictionaries = None
+
+
+def connect(readonly=False, snapshot=None):
+    """A tuned connection; read-only ones can't write even by mistake.
+    `snapshot` is the path of a published snapshot, opened immutable:
+    SQLite neither locks it nor checks it for changes, it never changes"""
+    if snapshot is not None:
+        con = sqlite3.connect(
+            f"file:{quote(snapshot)}?mode=ro&immutable=1",
+            uri=True,
+            cached_statements=CACHED_STATEMENTS,
+        )
+    elif readonly:
+        con = sqlite3.connect(
+            f"file:{quote(DATABASE)}?mode=ro",
+            uri=True,
+            cached_statements=CACHED_STATEMENTS,
+        )
+    else:
+        con = sqlite3.connect(DATABASE, cached_statements=CACHED_STATEMENTS)
+    con.row_factory = sqlite3.Row
+    # used by the search index, see schema.sql
+    con.create_function("decompress_content", 1, decompress_content, deterministic=True)
+    for name, value in PRAGMAS:
+        con.execute(f"PRAGMA {name} = {value}")
+    if readonly or snapshot is not None:
+        con.execute("PRAGMA query_only = ON")
+    else:
+        # persistent, stored in the database file
+        con.execute("PRAGMA journal_mode = WAL")
+    return con
+
+
+def thread_connections():
+    """Connections are opened once per process and thread, then reused by
+    every request (or command) running there"""
+    if getattr(local, "pid", None) != os.getpid():
+        # forked: the parent's connections must not be used here
+        local.pid = os.getpid()
+        local.connections = {}
+        local.snapshot_inode = None
+    return local.connections
+
+
+def connection(readonly):
+    connections = thread_connections()
+    if readonly not in connections:
+        connections[readonly] = connect(readonly)
+    return connections[readonly]
+
+
+def get_snapshot_db():
+    """Connection to the snapshot, None if none was published yet.
+    publish_snapshot replaces the file, so a new inode means a new
+    snapshot: the connection to the previous one is closed"""
+    try:
+        inode = os.stat(SNAPSHOT_DATABASE).st_ino
+    except FileNotFoundError:
+        return None
+    connections = thread_connections()
+    if local.snapshot_inode != inode:
+        if "snapshot" in connections:
+            connections.pop("snapshot").close()
+        connections["snapshot"] = connect(snapshot=SNAPSHOT_DATABASE)
+        local.snapshot_inode = inode
+    return connections["snapshot"]
+
+
+def get_dictionaries(reload=False):
+    """Reads content_dictionaries on a connection of its own: it's also
+    needed by decompress_content, while a query runs"""
+    global dictionaries
+    if dictionaries is None or reload:
+        con = sqlite3.connect(f"file:{quote(DATABASE)}?mode=ro", uri=True)
+        try:
+            dictionaries = dict(
+                con.execute("SELECT id, data FROM content_dictionaries")
+            )
+        finally:
+            con.close()
+    return dictionaries
+
+
+def compress_content(text):
+    """feed_items.content as stored, compressed with the newest dictionary
+    this process knows of (see build-content-dictionary). Content that is
+    already compressed is returned as is"""
+    if isinstance(text, bytes):
+        return text
+    known = get_dictionaries()
+    if not known:
+        return compression.compress(text)
+    newest = max(known)
+    return compression.compress(text, (newest, known[newest]))
+
+
+def decompress_content(value):
+    """Text of feed_items.content, whether it's compressed or not"""
+    known = get_dictionaries()
+    needed = compression.dictionary_id(value)
+    if needed is not None and needed not in known:
+        # made by another process after this one read them
+        known = get_dictionaries(reload=True)
+    return compression.decompress(value, known)
+
 
 def get_db():
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-    return db
+    """Connection for writes"""
+    return connection(readonly=False)
+
+
+def get_read_db():
+    return connection(readonly=True)
+
+
+def end_transactions():
+    """Rolls back what a failed request left uncommitted, so the reused
+    connection doesn't keep holding the write lock"""
+    for con in getattr(local, "connections", {}).values():
+        if con.in_transaction:
+            con.rollback()
 
 
 def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
+    cur = get_read_db().execute(query, args)
+    rv = cur.fetchall()
+    cur.close()
+    return (rv[0] if rv else None) if one else rv
+
+
+def query_site(query, args=(), one=False):
+    """query_db for what the web pages show: reads the snapshot when one
+    is published, so they never wait on process-feeds and the commands"""
+    con = get_snapshot_db() if SNAPSHOT_DATABASE else None
+    if con is None:
+        return query_db(query, args, one)
+    cur = con.execute(query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
@@ -52,30 +202,48 @@ def get_oldest_crawled_feed():
     )
 
 
-def get_stalest_feeds(limit, status_ids):
-    status_ids = list(status_ids)
-    placeholders = ",".join("?" for _ in status_ids)
-
-    query = f"""
-        SELECT f.*, MAX(fc.crawled_at) AS last_crawled_at
-        FROM feeds f
-        LEFT JOIN feed_crawls fc ON f.id = fc.feed_id
-        WHERE f.status_id IN ({placeholders})
-        GROUP BY f.id
-        ORDER BY last_crawled_at ASC"""
-    params = status_ids.copy()
+def stalest_feeds_query(limit, status_ids):
+    """One indexed query per status, merged: SQLite can't walk
+    idx_feeds_status_last_crawled_at in order for several statuses at once,
+    it would sort them all instead"""
+    query = " UNION ALL ".join(
+        "SELECT * FROM feeds WHERE status_id = ?" for _ in status_ids
+    )
+    query += " ORDER BY last_crawled_at ASC"
+    params = list(status_ids)
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
-    return query_db(query, params)
+    return query, params
 
 
-def get_blocked_feeds_description():
-    return query_db(
-        "SELECT f.domain, fs.name, fsh1.descr FROM feeds f INNER JOIN feed_status fs ON f.status_id = fs.id LEFT JOIN feed_status_history fsh1 ON (f.id = fsh1.feed_id ) LEFT OUTER JOIN feed_status_history fsh2 ON (f.id = fsh2.feed_id AND fsh1.created_at < fsh2.created_at) WHERE f.status_id = 4 ORDER BY fsh1.created_at DESC"
+def get_stalest_feeds(limit, status_ids):
+    return query_db(*stalest_feeds_query(limit, status_ids))
+
+
+def explain_query_plan(query, params=()):
+    """The steps of the query's plan, like "SEARCH feeds USING INDEX ..." """
+    return [row["detail"] for row in query_db(f"EXPLAIN QUERY PLAN {query}", params)]
+
+
+def blocked_feeds_query(reason=None):
+    """Blocked feeds by reason, then most recently blocked, straight from
+    idx_feeds_status_reason"""
+    if reason is not None:
+        return (
+            "SELECT f.domain, f.feed_url, f.status_reason AS descr, f.status_changed_at FROM feeds f WHERE f.status_id = 4 AND f.status_reason = ? ORDER BY f.status_changed_at DESC",
+            [reason],
+        )
+    return (
+        "SELECT f.domain, f.feed_url, f.status_reason AS descr, f.status_changed_at FROM feeds f WHERE f.status_id = 4 ORDER BY f.status_reason, f.status_changed_at DESC",
+        [],
     )
 
 
+def get_blocked_feeds_description(reason=None):
+    return query_db(*blocked_feeds_query(reason))
+
+
 def get_feeds():
     return query_db("SELECT domain FROM feeds")
 
@@ -97,8 +265,12 @@ def insert_feed(domain, feed_url, status_id):
 
 def batch_update_crawled_at(feed_ids):
     con = get_db()
-    con.executemany("INSERT INTO feed_crawls (feed_id) VALUES (?)", feed_ids)
-    con.commit()
+    with con:
+        con.executemany("INSERT INTO feed_crawls (feed_id) VALUES (?)", feed_ids)
+        con.executemany(
+            "UPDATE feeds SET last_crawled_at = CURRENT_TIMESTAMP WHERE id = ?",
+            feed_ids,
+        )
 
 
 def get_report(feed_id, hash_id):
@@ -127,11 +299,15 @@ def delete_report(feed_id, hash_id):
 
 def insert_feed_history(feed_id, status_id, desc):
     con = get_db()
-    con.execute(
-        "INSERT INTO feed_status_history (feed_id, status_id, descr) VALUES (?, ?, ?)",
-        [feed_id, status_id, desc],
-    )
-    con.commit()
+    with con:
+        con.execute(
+            "INSERT INTO feed_status_history (feed_id, status_id, descr) VALUES (?, ?, ?)",
+            [feed_id, status_id, desc],
+        )
+        con.execute(
+            "UPDATE feeds SET status_reason = ?, status_changed_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [desc, feed_id],
+        )
 
 
 def get_blocklist():
@@ -144,110 +320,362 @@ def add_to_blocklist(domain):
     con.commit()
 
 
-def get_feeds_for_processing(num_feeds, last_process_interval):
-    cutoff = datetime.utcnow() - timedelta(minutes=last_process_interval)
-    return query_db(
-        "SELECT * FROM feeds WHERE (last_checked_at IS NULL OR last_checked_at <= ?) AND status_id IN (1, 2) AND processing_status_id = 1 ORDER BY COALESCE(last_checked_at, '1970-01-01 00:00:00') ASC LIMIT ?",
-        [cutoff, num_feeds],
-    )
+def claim_feeds_for_processing(worker_id, num_feeds, lease, lookahead=0):
+    """Claims up to `num_feeds` feeds due for a check within the next
+    `lookahead` seconds for `lease` seconds, so processors running at the
+    same time never pick the same feeds. Feeds claimed by anyone, this
+    worker included, are skipped until their claim is released (see
+    WriteBuffer.flush) or expires."""
+    con = get_db()
+    with con:
+        feeds = con.execute(
+            "UPDATE feeds SET claimed_by = ?, claimed_until = DATETIME('now', ?) WHERE id IN (SELECT id FROM feeds WHERE (next_check_at IS NULL OR next_check_at <= DATETIME('now', ?)) AND status_id IN (1, 2) AND processing_status_id = 1 AND (claimed_until IS NULL OR claimed_until <= DATETIME('now')) ORDER BY COALESCE(next_check_at, '1970-01-01 00:00:00') ASC LIMIT ?) RETURNING *",
+            [worker_id, f"+{lease} seconds", f"+{lookahead} seconds", num_feeds],
+        ).fetchall()
+    # RETURNING doesn't keep the subquery's order
+    return sorted(feeds, key=lambda feed: feed["next_check_at"] or "")
 
 
-def insert_feed_item(
-    feed_id, entry_title, entry_url, entry_guid, entry_date, entry_author, entry_content
-):
+def renew_claims(worker_id, lease):
+    con = get_db()
+    with con:
+        con.execute(
+            "UPDATE feeds SET claimed_until = DATETIME('now', ?) WHERE claimed_by = ?",
+            [f"+{lease} seconds", worker_id],
+        )
+
 
+def release_claims(worker_id):
     con = get_db()
-    con.execute(
-        "INSERT INTO feed_items (feed_id, title, url, guid, published_at, author, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        [
-            feed_id,
-            entry_title,
-            entry_url,
-            entry_guid,
-            entry_date,
-            entry_author,
-            entry_content,
-        ],
+    with con:
+        con.execute(
+            "UPDATE feeds SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = ?",
+            [worker_id],
+        )
+
+
+def get_recent_post_dates(feed_id, limit):
+    return [
+        row["published_at"]
+        for row in query_db(
+            "SELECT published_at FROM feed_items WHERE feed_id = ? ORDER BY published_at DESC LIMIT ?",
+            [feed_id, limit],
+        )
+    ]
+
+
+def get_recent_guids(feed_id, limit):
+    # as text, like the parsers give them (see get_known_guids)
+    return frozenset(
+        row["guid"]
+        for row in query_db(
+            "SELECT CAST(guid AS TEXT) AS guid FROM feed_items WHERE feed_id = ? ORDER BY published_at DESC LIMIT ?",
+            [feed_id, limit],
+        )
     )
-    con.commit()
 
 
-def mark_feed_checked(feed_id):
+def get_known_guids(feed_id, guids):
+    """Which of `guids` are already stored for the feed, in a single query.
+    They are returned as given: guid has INTEGER affinity, so a numeric
+    guid is stored as a number ("0123" as 123) but still compares equal"""
+    return {
+        row["guid"]
+        for row in query_db(
+            "SELECT value AS guid FROM json_each(?2) WHERE EXISTS (SELECT 1 FROM feed_items WHERE feed_id = ?1 AND guid = value)",
+            [feed_id, json.dumps(guids)],
+        )
+    }
+
+
+# caches latest_feed_items' row count, see get_latest_feed_items_count
+COUNT_LATEST_POSTS = "INSERT INTO site_stats (name, value) SELECT 'latest_feed_items', COUNT(*) FROM latest_feed_items WHERE TRUE ON CONFLICT (name) DO UPDATE SET value = excluded.value"
+# and when its rows last changed, in unix time, see
+# get_latest_feed_items_refreshed_at
+LATEST_POSTS_REFRESHED = "INSERT INTO site_stats (name, value) VALUES ('latest_feed_items_refreshed_at', CAST(STRFTIME('%s', 'now') AS INTEGER)) ON CONFLICT (name) DO UPDATE SET value = excluded.value"
+
+# latest_feed_items rows: each feed's newest post that isn't dated in the
+# future (WriteBuffer.flush adds a WHERE and LATEST_POST_ON_CONFLICT to
+# it). published_at is stored as 2024-01-02T03:04:05, normalized by
+# DATETIME to compare with DATETIME('now')
+LATEST_POST_UPSERT = """INSERT INTO latest_feed_items (feed_id, feed_item_id, title, url, published_at, feed_domain, feed_url, last_refreshed)
+SELECT f.id, fi.id, fi.title, fi.url, fi.published_at, f.domain, f.feed_url, CURRENT_TIMESTAMP
+FROM feeds f
+INNER JOIN feed_items fi ON fi.id = (
+    SELECT id FROM feed_items
+    WHERE feed_id = f.id AND DATETIME(published_at) <= DATETIME('now')
+    ORDER BY published_at DESC
+    LIMIT 1
+)"""
+LATEST_POST_ON_CONFLICT = "ON CONFLICT (feed_id) DO UPDATE SET feed_item_id = excluded.feed_item_id, title = excluded.title, url = excluded.url, published_at = excluded.published_at, feed_domain = excluded.feed_domain, feed_url = excluded.feed_url, last_refreshed = excluded.last_refreshed"
+
+# feeds with a post newer than their latest_feed_items row that is no
+# longer dated in the future: it was skipped when it came in
+DUE_POSTS_FILTER = """WHERE EXISTS (
+    SELECT 1 FROM feed_items
+    WHERE feed_id = f.id
+    AND published_at > COALESCE((SELECT published_at FROM latest_feed_items WHERE feed_id = f.id), '')
+    AND DATETIME(published_at) <= DATETIME('now')
+)"""
+# seconds between two looks for them, it costs an index lookup per feed
+DUE_POSTS_EVERY = 600
+
+
+# the search index is kept in sync with feed_items by the writes of this
+# module, not by triggers: it reads the text through decompress_content,
+# which the sqlite3 shell doesn't have (see schema.sql). Run REMOVE before
+# changing a post's title or content and ADD after, both with its id
+SEARCH_INDEX_ADD = "INSERT INTO feed_items_fts (rowid, title, content) SELECT id, title, content FROM feed_items_text WHERE id = ?"
+SEARCH_INDEX_REMOVE = "INSERT INTO feed_items_fts (feed_items_fts, rowid, title, content) SELECT 'delete', id, title, content FROM feed_items_text WHERE id = ?"
+
+
+class WriteBuffer:
+    """Collects the writes produced while processing feeds and applies
+    them in a single transaction on `flush`, so a feed with hundreds of
+    new entries (or a whole batch of feeds) costs one commit."""
+
+    def __init__(self):
+        self.clear()
+        self.due_posts_at = 0
+
+    def clear(self):
+        self.feeds = 0
+        self.checked = []
+        self.items = []
+        # feeds with new posts, whose latest_feed_items row is refreshed
+        self.posted = {}
+        self.latest = []
+        self.validators = []
+        self.schedules = []
+        self.paused = []
+        self.missing_content = []
+
+    def mark_checked(self, feed_id):
+        self.feeds += 1
+        self.checked.append((feed_id,))
+
+    def add_item(
+        self,
+        feed_id,
+        entry_title,
+        entry_url,
+        entry_guid,
+        entry_date,
+        entry_author,
+        entry_content,
+    ):
+        self.items.append(
+            (
+                feed_id,
+                entry_title,
+                entry_url,
+                entry_guid,
+                entry_date,
+                entry_author,
+                compress_content(entry_content),
+            )
+        )
+        self.posted[feed_id] = (feed_id,)
+        # empty, not None: content is being saved but the feed had none
+        if entry_content == "":
+            self.missing_content.append((feed_id, entry_guid))
+
+    def set_latest(self, feed_id, last_post_guid):
+        self.latest.append((last_post_guid, feed_id, last_post_guid, feed_id))
+
+    def set_validators(self, feed_id, etag, modified, body_hash, entries_hash):
+        self.validators.append((etag, modified, body_hash, entries_hash, feed_id))
+
+    def schedule(self, feed_id, next_check_at, error_streak, retry_after=None):
+        self.schedules.append((next_check_at, error_streak, retry_after, feed_id))
+
+    def pause(self, feed_id):
+        self.paused.append((feed_id,))
+
+    def flush(self):
+        if self.feeds == 0:
+            return
+        con = get_db()
+        with con:
+            con.executemany(
+                "UPDATE feeds SET last_checked_at = DATETIME('now'), claimed_by = NULL, claimed_until = NULL WHERE id = ?",
+                self.checked,
+            )
+            inserted = []
+            for item in self.items:
+                cursor = con.execute(
+                    "INSERT OR IGNORE INTO feed_items (feed_id, title, url, guid, published_at, author, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    item,
+                )
+                if cursor.rowcount:
+                    inserted.append((cursor.lastrowid,))
+            con.executemany(SEARCH_INDEX_ADD, inserted)
+            con.executemany(
+                "INSERT OR IGNORE INTO content_fetch_queue (feed_item_id, url) SELECT id, url FROM feed_items WHERE feed_id = ? AND guid = ? AND content = ''",
+                self.missing_content,
+            )
+            refreshed = con.executemany(
+                f"{LATEST_POST_UPSERT} WHERE f.id = ? {LATEST_POST_ON_CONFLICT}",
+                self.posted.values(),
+            ).rowcount
+            if time.monotonic() - self.due_posts_at >= DUE_POSTS_EVERY:
+                refreshed += con.execute(
+                    f"{LATEST_POST_UPSERT} {DUE_POSTS_FILTER} {LATEST_POST_ON_CONFLICT}"
+                ).rowcount
+                self.due_posts_at = time.monotonic()
+            if refreshed > 0:
+                con.execute(COUNT_LATEST_POSTS)
+                con.execute(LATEST_POSTS_REFRESHED)
+            con.executemany(
+                "UPDATE feeds SET last_post_guid = ?, last_feed_item_id = (SELECT id FROM feed_items WHERE feed_id = ? AND guid = ?) WHERE id = ?",
+                self.latest,
+            )
+            con.executemany(
+                "UPDATE feeds SET etag = ?, modified = ?, body_hash = ?, entries_hash = ? WHERE id = ?",
+                self.validators,
+            )
+            con.executemany(
+                "UPDATE feeds SET next_check_at = ?, error_streak = ?, retry_after = ? WHERE id = ?",
+                self.schedules,
+            )
+            con.executemany(
+                "UPDATE feeds SET processing_status_id = 2 WHERE id = ?",
+                self.paused,
+            )
+        self.clear()
+
+
+def resume_feeds(domain=None):
+    """Puts paused feeds back in the processing queue, due right away"""
+    sql = "UPDATE feeds SET processing_status_id = 1, error_streak = 0, retry_after = NULL, next_check_at = NULL WHERE processing_status_id = 2"
+    params = []
+    if domain:
+        sql += " AND domain = ?"
+        params.append(domain)
     con = get_db()
-    con.execute(
-        "UPDATE feeds SET last_checked_at = DATETIME('now') WHERE id = ?", [feed_id]
+    with con:
+        return con.execute(sql, params).rowcount
+
+
+def get_content_fetch_batch(limit):
+    return query_db(
+        "SELECT feed_item_id, url, attempts FROM content_fetch_queue WHERE next_attempt_at <= DATETIME('now') ORDER BY next_attempt_at ASC LIMIT ?",
+        [limit],
     )
-    con.commit()
 
 
-def get_id_from_guid(feed_id, feed_item_guid):
-    res = query_db(
-        "SELECT id FROM feed_items WHERE feed_id = ? AND guid = ? ORDER BY id DESC LIMIT 1",
-        args=[feed_id, feed_item_guid],
-        one=True,
+def get_url_fetch_cache(urls, max_age_days):
+    rows = query_db(
+        "SELECT url, status, decompress_content(content) AS content FROM url_fetch_cache WHERE url IN (SELECT value FROM json_each(?)) AND fetched_at >= DATETIME('now', ?)",
+        [json.dumps(urls), f"-{max_age_days} days"],
     )
-    return res["id"]
+    return {row["url"]: row for row in rows}
 
 
-def update_feed_latest(feed_id, last_post_guid, last_feed_item_id):
+def expire_url_fetch_cache(max_age_days):
+    """Deletes the downloads too old for get_url_fetch_cache to return"""
     con = get_db()
-    con.execute(
-        "UPDATE feeds SET last_feed_item_id = ?, last_post_guid = ? WHERE id = ?",
-        [last_feed_item_id, last_post_guid, feed_id],
-    )
-    con.commit()
+    with con:
+        return con.execute(
+            "DELETE FROM url_fetch_cache WHERE fetched_at < DATETIME('now', ?)",
+            [f"-{max_age_days} days"],
+        ).rowcount
 
 
-def pause_feed_processing(feed_id):
+def save_content_fetches(filled, retries, dropped, fetched):
+    """filled: (content, feed_item_id), retries: (delay, feed_item_id),
+    dropped: (feed_item_id,), fetched: (url, status, content)"""
     con = get_db()
-    con.execute("UPDATE feeds SET processing_status_id = 2 WHERE id = ?", [feed_id])
-    con.commit()
+    ids = [(feed_item_id,) for _, feed_item_id in filled]
+    with con:
+        con.executemany(SEARCH_INDEX_REMOVE, ids)
+        con.executemany(
+            "UPDATE feed_items SET content = ? WHERE id = ?",
+            [
+                (compress_content(content), feed_item_id)
+                for content, feed_item_id in filled
+            ],
+        )
+        con.executemany(SEARCH_INDEX_ADD, ids)
+        con.executemany(
+            "DELETE FROM content_fetch_queue WHERE feed_item_id = ?", ids + dropped
+        )
+        con.executemany(
+            "UPDATE content_fetch_queue SET attempts = attempts + 1, next_attempt_at = DATETIME('now', ?) WHERE feed_item_id = ?",
+            retries,
+        )
+        con.executemany(
+            "INSERT INTO url_fetch_cache (url, status, content) VALUES (?, ?, ?) ON CONFLICT (url) DO UPDATE SET status = excluded.status, content = excluded.content, fetched_at = CURRENT_TIMESTAMP",
+            [
+                (url, status, compress_content(content))
+                for url, status, content in fetched
+            ],
+        )
 
 
 def refresh_latest_posts():
+    """Rebuilds latest_feed_items from all of feed_items. WriteBuffer.flush
+    keeps it up to date as posts come in, this is only needed to repair it"""
     con = get_db()
-    con.execute("DELETE FROM latest_feed_items")
-    con.execute("""
-INSERT INTO latest_feed_items (feed_id, feed_item_id, title, url, published_at, feed_domain, feed_url, last_refreshed)
-SELECT
-    f.id AS feed_id,
-    fi.id AS feed_item_id,
-    fi.title,
-    fi.url,
-    fi.published_at,
-    f.domain AS feed_domain,
-    f.feed_url,
-    CURRENT_TIMESTAMP
-FROM feeds f
-INNER JOIN (
-    SELECT
-        fi.*,
-        ROW_NUMBER() OVER (PARTITION BY fi.feed_id ORDER BY fi.published_at DESC) as rn
-    FROM feed_items fi
-) fi ON f.id = fi.feed_id AND fi.rn = 1
-WHERE fi.id IS NOT NULL AND fi.published_at <= DATETIME('now')
-ORDER BY fi.published_at DESC;
-""")
-    con.commit()
+    with con:
+        con.execute("DELETE FROM latest_feed_items")
+        con.execute(LATEST_POST_UPSERT)
+        con.execute(COUNT_LATEST_POSTS)
+        con.execute(LATEST_POSTS_REFRESHED)
 
 
-def get_latest_feed_items(per_page=10, page=1):
-    if page <= 1:
-        page = 1
-    return query_db(
-        "SELECT * FROM latest_feed_items ORDER BY published_at DESC LIMIT ? OFFSET ?;",
-        [per_page, (page - 1) * per_page],
+def get_latest_feed_items_refreshed_at():
+    """Kept in site_stats by the writes to latest_feed_items"""
+    row = query_site(
+        "SELECT DATETIME(value, 'unixepoch') AS last_refreshed FROM site_stats WHERE name = 'latest_feed_items_refreshed_at'",
+        one=True,
+    )
+    return row["last_refreshed"] if row else None
+
+
+def latest_feed_items_query(limit, after=None, before=None):
+    """Newest first, ties by feed_id: the order of
+    idx_latest_feed_items_published, so a page is read straight from it
+    wherever it starts. `after` and `before` are (published_at, feed_id)
+    cursors, `before` reads backwards (oldest first)"""
+    if after is not None:
+        return (
+            "SELECT * FROM latest_feed_items WHERE published_at <= ?1 AND (published_at < ?1 OR feed_id > ?2) ORDER BY published_at DESC, feed_id ASC LIMIT ?3",
+            [*after, limit],
+        )
+    if before is not None:
+        return (
+            "SELECT * FROM latest_feed_items WHERE published_at >= ?1 AND (published_at > ?1 OR feed_id < ?2) ORDER BY published_at ASC, feed_id DESC LIMIT ?3",
+            [*before, limit],
+        )
+    return (
+        "SELECT * FROM latest_feed_items ORDER BY published_at DESC, feed_id ASC LIMIT ?",
+        [limit],
     )
 
 
+def get_latest_feed_items(per_page=10, after=None, before=None):
+    """A page of latest posts, the first one or the one after/before a
+    cursor. Returns (items, more): whether there are more items past the
+    page in the direction it was read"""
+    items = query_site(*latest_feed_items_query(per_page + 1, after, before))
+    more = len(items) > per_page
+    items = items[:per_page]
+    if before is not None:
+        items.reverse()
+    return items, more
+
+
 def get_latest_feed_items_count():
-    return query_db("SELECT COUNT(*) as count FROM latest_feed_items", one=True)[
-        "count"
-    ]
+    """Kept in site_stats by the writes to latest_feed_items"""
+    row = query_site(
+        "SELECT value FROM site_stats WHERE name = 'latest_feed_items'", one=True
+    )
+    return row["value"] if row else 0
 
 
 def get_active_feeds_with_posts():
-    return query_db(
+    return query_site(
         """SELECT f.domain, f.feed_url
            FROM feeds f
            INNER JOIN latest_feed_items lfi ON f.id = lfi.feed_id
@@ -256,6 +684,187 @@ def get_active_feeds_with_posts():
 
 
 def get_inactive_feeds():
-    return query_db(
+    return query_site(
         "SELECT domain, feed_url FROM feeds WHERE processing_status_id = 2"
     )
+
+
+# only the most recent matches are ranked: bm25 reads every occurrence of
+# the words in every match, too slow for common words in millions of posts
+SEARCH_CANDIDATES = 1000
+
+# around the matches in search_feed_items' snippets
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+
+def fts_query(text):
+    """Every word of `text` has to match, quoted so that punctuation and
+    FTS5 operators are searched as plain text"""
+    return " AND ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def search_feed_items(text, per_page=20, page=1):
+    """Posts matching every word of `text`, best first (bm25, matches in
+    the title weigh more, among the SEARCH_CANDIDATES most recent ones),
+    with a snippet of their content around the matches. Returns (items,
+    more) like get_latest_feed_items"""
+    query = fts_query(text)
+    if not query:
+        return [], False
+    items = query_db(
+        "SELECT fi.id, fi.title, fi.url, fi.published_at, f.domain AS feed_domain, snippet(feed_items_fts, 1, ?1, ?2, '…', 24) AS snippet FROM feed_items_fts INNER JOIN feed_items fi ON fi.id = feed_items_fts.rowid INNER JOIN feeds f ON f.id = fi.feed_id WHERE feed_items_fts MATCH ?3 AND feed_items_fts.rowid >= (SELECT MIN(rowid) FROM (SELECT rowid FROM feed_items_fts WHERE feed_items_fts MATCH ?3 ORDER BY rowid DESC LIMIT ?4)) ORDER BY bm25(feed_items_fts, 5.0, 1.0) LIMIT ?5 OFFSET ?6",
+        [
+            SNIPPET_START,
+            SNIPPET_END,
+            query,
+            SEARCH_CANDIDATES,
+            per_page + 1,
+            (page - 1) * per_page,
+        ],
+    )
+    return items[:per_page], len(items) > per_page
+
+
+def rebuild_search_index():
+    con = get_db()
+    with con:
+        con.execute("INSERT INTO feed_items_fts (feed_items_fts) VALUES ('rebuild')")
+
+
+def get_content_sample(limit):
+    """Text of the `limit` most recent posts that have some"""
+    return [
+        row["content"]
+        for row in query_db(
+            "SELECT decompress_content(content) AS content FROM feed_items WHERE content IS NOT NULL AND content != '' ORDER BY id DESC LIMIT ?",
+            [limit],
+        )
+    ]
+
+
+def add_content_dictionary(data):
+    """New posts are compressed with it by processes started afterwards"""
+    con = get_db()
+    with con:
+        return con.execute(
+            "INSERT INTO content_dictionaries (data) VALUES (?)", [data]
+        ).lastrowid
+
+
+def compress_stored_content(batch_size):
+    """Compresses the content stored as plain text, `batch_size` posts per
+    transaction. Returns how many posts were compressed"""
+    con = get_db()
+    compressed = 0
+    last_id = 0
+    while True:
+        rows = con.execute(
+            "SELECT id, content FROM feed_items WHERE id > ? AND typeof(content) = 'text' AND content != '' ORDER BY id LIMIT ?",
+            [last_id, batch_size],
+        ).fetchall()
+        if not rows:
+            return compressed
+        with con:
+            con.executemany(
+                "UPDATE feed_items SET content = ? WHERE id = ?",
+                [(compress_content(row["content"]), row["id"]) for row in rows],
+            )
+        compressed += len(rows)
+        last_id = rows[-1]["id"]
+
+
+def archive_content(archive_path, months, batch_size):
+    """Moves the content of posts published more than `months` months ago
+    to the database at `archive_path`, `batch_size` posts per transaction.
+
+    The posts stay in feed_items without their content: process-feeds
+    still knows them, and they are still found by title. Returns how many
+    posts were archived"""
+    con = get_db()
+    con.execute("ATTACH DATABASE ? AS archive", [archive_path])
+    try:
+        with con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS archive.feed_item_contents (feed_item_id INTEGER PRIMARY KEY, content BLOB NOT NULL, archived_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+            )
+            # needed to read the content back
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS archive.content_dictionaries (id INTEGER PRIMARY KEY, data BLOB NOT NULL, created_at DATETIME NOT NULL)"
+            )
+            con.execute(
+                "INSERT OR IGNORE INTO archive.content_dictionaries SELECT * FROM main.content_dictionaries"
+            )
+        archived = 0
+        last_id = 0
+        while True:
+            rows = con.execute(
+                "SELECT id, content FROM feed_items WHERE id > ? AND DATETIME(published_at) < DATETIME('now', ?) AND content IS NOT NULL ORDER BY id LIMIT ?",
+                [last_id, f"-{months} months", batch_size],
+            ).fetchall()
+            if not rows:
+                return archived
+            ids = [(row["id"],) for row in rows]
+            with con:
+                # empty content was waiting for backfill-content, dropped
+                con.executemany(
+                    "INSERT OR REPLACE INTO archive.feed_item_contents (feed_item_id, content) VALUES (?, ?)",
+                    [
+                        (row["id"], compress_content(row["content"]))
+                        for row in rows
+                        if row["content"]
+                    ],
+                )
+                con.executemany(SEARCH_INDEX_REMOVE, ids)
+                con.executemany(
+                    "UPDATE feed_items SET content = NULL WHERE id = ?", ids
+                )
+                con.executemany(SEARCH_INDEX_ADD, ids)
+                con.executemany(
+                    "DELETE FROM content_fetch_queue WHERE feed_item_id = ?", ids
+                )
+            archived += len(rows)
+            last_id = rows[-1]["id"]
+    finally:
+        con.execute("DETACH DATABASE archive")
+
+
+def vacuum():
+    """Shrinks the database file to the pages in use"""
+    get_db().execute("VACUUM")
+
+
+def publish_snapshot(path):
+    """Writes what the site shows (latest_feed_items, site_stats and the
+    feeds listed on /sources) to a new database, then replaces `path` with
+    it in one rename. Web workers reading the previous snapshot keep it
+    open until they see the new one, see get_snapshot_db"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    con = sqlite3.connect(f"file:{quote(tmp_path)}", uri=True)
+    try:
+        con.execute("ATTACH DATABASE ? AS live", [f"file:{quote(DATABASE)}?mode=ro"])
+        # same definitions and indexes as in the live database
+        for (sql,) in con.execute(
+            "SELECT sql FROM live.sqlite_schema WHERE tbl_name IN ('latest_feed_items', 'site_stats') AND sql IS NOT NULL ORDER BY type DESC"
+        ).fetchall():
+            con.execute(sql)
+        con.execute(
+            "CREATE TABLE feeds (id INTEGER PRIMARY KEY, domain TEXT NOT NULL, feed_url TEXT NOT NULL, processing_status_id INTEGER)"
+        )
+        # a single read transaction: the tables are copied as of one moment
+        con.execute("BEGIN")
+        con.execute(
+            "INSERT INTO main.latest_feed_items SELECT * FROM live.latest_feed_items"
+        )
+        con.execute("INSERT INTO main.site_stats SELECT * FROM live.site_stats")
+        con.execute(
+            "INSERT INTO main.feeds SELECT id, domain, feed_url, processing_status_id FROM live.feeds WHERE processing_status_id = 2 OR id IN (SELECT feed_id FROM live.latest_feed_items)"
+        )
+        con.commit()
+        con.execute("DETACH DATABASE live")
+        con.execute("ANALYZE")
+    finally:
+        con.close()
+    os.replace(tmp_path, path)
@@ -1,21 +1,73 @@
 from db import (
-    get_feeds_for_processing,
-    insert_feed_item,
-    mark_feed_checked,
-    get_id_from_guid,
-    update_feed_latest,
-    pause_feed_processing,
+    claim_feeds_for_processing,
+    get_known_guids,
+    get_recent_guids,
+    get_recent_post_dates,
+    release_claims,
+    renew_claims,
+    WriteBuffer,
+)
+from fetcher import fetch, FetchError, FetchTimeout, MAX_BYTES, POOL
+from feed_stream import iter_feed, StreamParseError
+from html_text import html_to_text
+from metrics import Metrics, PHASES
+from scheduler import (
+    next_check_at,
+    retry_after,
+    format_datetime,
+    DEAD_ERROR_STREAK,
+    HISTORY_SIZE,
 )
 import feedparser
+import hashlib
+import heapq
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlparse
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+
+# how many of a feed's latest guids are handed to the parse stage
+RECENT_GUIDS = 500
+
+# bodies larger than this are read incrementally, see feed_stream
+STREAM_ABOVE = 1024 * 1024
+
+# in stream mode, reading stops after this many known entries in a row
+KNOWN_STREAK = 10
+
+# tries of the last writes on exit, each waits up to busy_timeout
+SHUTDOWN_ATTEMPTS = 3
+
+TRUNCATION_REASONS = {
+    "bytes": "body larger than the size limit",
+    "entries": "more entries than the entry limit",
+    "known": f"stopped after {KNOWN_STREAK} known entries in a row",
+}
 
 
-def status_nok(feed):
-    """feedparser uses requests lib under the hood, so we can
-    mimic its behaviour. see requests/src/requests/models.py:Requests::ok"""
-    return feed.status >= 400
+def status_not_modified(response):
+    """Server honored our If-None-Match / If-Modified-Since headers"""
+    return response.status == 304
+
+
+def status_nok(response):
+    """mimics requests behaviour.
+    see requests/src/requests/models.py:Requests::ok"""
+    return response.status >= 400
 
 
 def get_feed_title(feed):
@@ -57,15 +109,9 @@ def get_entry_content(entry):
 def clean_content(html_content):
     """
     From https://www.alexmolas.com/2024/02/05/a-search-engine-in-80-lines.html
+    now without building a BeautifulSoup tree, see html_text.py
     """
-    soup = BeautifulSoup(html_content, "html.parser")
-    for script in soup(["script", "style"]):
-        script.extract()
-    text = soup.get_text()
-    lines = (line.strip() for line in text.splitlines())
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-    cleaned_text = " ".join(chunk for chunk in chunks if chunk)
-    return cleaned_text
+    return html_to_text(html_content)
 
 
 def log(msg, level):
@@ -73,27 +119,232 @@ def log(msg, level):
     print(f"[{level}] [{dt}] {msg}", flush=True)
 
 
-def parse_with_timeout(feed_url, timeout=30):
-    """Parse feed with timeout to prevent hanging on slow/unresponsive feeds"""
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(feedparser.parse, feed_url)
+def feedparser_entries(parsed):
+    for entry in parsed.entries:
+        yield {
+            "title": get_entry_title(entry),
+            "url": get_entry_url(entry),
+            "guid": get_entry_guid(entry),
+            "date": get_entry_date(entry),
+            "author": get_entry_author(entry),
+            "content": get_entry_content(entry),
+        }
+
+
+def stream_entries(events, result):
+    for kind, value in events:
+        if kind == "title":
+            result["title"] = value or "untitled"
+            continue
+        yield {
+            "title": value["title"] or "untitled",
+            "url": value["url"],
+            "guid": value["guid"],
+            "date": value["date"],
+            "author": value["author"] or "",
+            "content": value["content"] or "",
+        }
+
+
+def read_entries(records, result, save_content, known_guids, max_entries, stream):
+    entries_hash = hashlib.sha256()
+    known_streak = 0
+
+    for record in records:
+        if max_entries and result["total_entries"] >= max_entries:
+            result["truncated"] = "entries"
+            break
+        result["total_entries"] += 1
+
+        valid = record["date"] and record["url"]
+        if valid:
+            entries_hash.update(
+                "\0".join(
+                    [record["guid"], record["url"], record["title"], record["date"]]
+                ).encode()
+            )
+
+        if valid and result["head_guid"] is None:
+            result["head_guid"] = record["guid"]
+
+        if valid and record["guid"] in known_guids:
+            result["known_entries"] += 1
+            known_streak += 1
+            # entries are usually newest first, once a few in a row are
+            # known the rest of a huge feed is very likely known as well
+            if stream and known_streak >= KNOWN_STREAK:
+                result["truncated"] = "known"
+                break
+            continue
+        known_streak = 0
+
+        entry_content = None
+        if valid and save_content:
+            entry_content = record["content"].strip()
+            # empty content is downloaded later from the entry url,
+            # see backfill.py
+            if len(entry_content) != 0:
+                started_at = time.monotonic()
+                entry_content = clean_content(entry_content)
+                result["clean_seconds"] += time.monotonic() - started_at
+        record["content"] = entry_content
+
+        result["entries"].append(record)
+
+    result["entries_hash"] = entries_hash.hexdigest()
+    return result
+
+
+def parse_feed(
+    body,
+    headers,
+    save_content=False,
+    known_guids=frozenset(),
+    max_entries=None,
+    stream=False,
+    truncated=False,
+):
+    """Parsing stage, runs on a worker process.
+
+    Turns the raw feed bytes into plain entry records, so only compact,
+    picklable data travels back to the database writer. Entries whose
+    guid is in `known_guids` are counted but not returned, and their
+    content is never cleaned. At most `max_entries` entries are read.
+
+    With `stream`, the body is read incrementally with feed_stream and
+    reading stops after KNOWN_STREAK known entries in a row; feedparser
+    is only used if the body isn't well-formed xml. `truncated` tells
+    the body was cut by the fetcher. The result's "truncated" key says
+    why the feed wasn't read to its end: "bytes", "entries" or "known".
+
+    "parse_seconds" and "clean_seconds" tell how long reading the feed
+    and cleaning the content of its entries took."""
+    started_at = time.monotonic()
+    result = read_feed(
+        body, headers, save_content, known_guids, max_entries, stream, truncated
+    )
+    result["parse_seconds"] = time.monotonic() - started_at - result["clean_seconds"]
+    return result
+
+
+def read_feed(body, headers, save_content, known_guids, max_entries, stream, truncated):
+    def new_result():
+        return {
+            "bozo": False,
+            "bozo_exception": "",
+            "title": "untitled",
+            "total_entries": 0,
+            "entries": [],
+            "head_guid": None,
+            "known_entries": 0,
+            "entries_hash": None,
+            "truncated": "bytes" if truncated else None,
+            "clean_seconds": 0,
+        }
+
+    args = (save_content, known_guids, max_entries, stream)
+    if stream:
+        result = new_result()
+        events = iter_feed(body, headers.get("content-location", ""))
         try:
-            return future.result(timeout=timeout)
-        except FutureTimeoutError:
-            return None
+            return read_entries(stream_entries(events, result), result, *args)
+        except StreamParseError:
+            pass
 
+    result = new_result()
+    parsed = feedparser.parse(body, response_headers=headers)
+    # a body cut short can't be well-formed, that's not the feed's fault
+    result["bozo"] = bool(parsed.bozo) and not truncated
+    result["bozo_exception"] = str(parsed.get("bozo_exception", ""))
+    result["title"] = get_feed_title(parsed.feed)
+    return read_entries(feedparser_entries(parsed), result, *args)
 
-class FeedProcessor:
-    """Adapted from github.com/manualdousuario/lerama and git.sr.ht/~lown/openorb"""
 
-    def __init__(self, save_content=False):
-        self.num_feeds = 25
-        self.min_process_interval = 120
+def ignore_stop_signals():
+    """Parse workers are shut down by the main process, which first
+    finishes the feeds in flight; see FeedProcessor.serve"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class HostLimiter:
+    """Caps how many requests may be in flight against the same host,
+    so a concurrent run doesn't hammer shared platforms like bearblog.dev"""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get(self, url):
+        host = urlparse(url).hostname or ""
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+class FeedProcessor:
+    """Adapted from github.com/manualdousuario/lerama and git.sr.ht/~lown/openorb
+
+    Downloads run on a pool of `concurrency` threads (at most `per_host`
+    at a time against the same host) and the downloaded bytes are parsed
+    on a pool of `parse_workers` processes, while everything that touches
+    the database happens on the calling thread, one feed at a time.
+    Writes are buffered and committed every `commit_every` feeds.
+
+    At most `max_bytes` of each feed and `max_entries` of its entries are
+    read; large bodies are parsed incrementally (see parse_feed).
+
+    The time each feed spends in every phase is aggregated in `metrics`,
+    summarized at the end of a run and written to `metrics_file` in the
+    Prometheus text format, if given.
+
+    Feeds are claimed in the database under `worker_id` for `lease`
+    seconds (renewed while they are being worked on), so several
+    processors can share the same database and split the feeds between
+    them. Claims are released as feeds are committed, or on exit."""
+
+    def __init__(
+        self,
+        save_content=False,
+        num_feeds=25,
+        concurrency=1,
+        per_host=2,
+        commit_every=1,
+        parse_workers=None,
+        max_entries=200,
+        max_bytes=MAX_BYTES,
+        metrics_file=None,
+        worker_id=None,
+    ):
+        self.num_feeds = num_feeds
         self.save_content = save_content
+        self.concurrency = concurrency
+        self.host_limiter = HostLimiter(per_host)
+        self.commit_every = commit_every
+        self.parse_workers = parse_workers
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.parser_pool = None
+        self.writer = WriteBuffer()
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        # per feed id, stats of the feeds in flight (see process)
+        self.stats = {}
+        self.processed = 0
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        # seconds a claim lasts without being renewed
+        self.lease = 600
+        self.renewed_at = time.monotonic()
+        # daemon mode settings, in seconds
+        self.lookahead = 300
+        self.idle_sleep = 30
+        self.stats_every = 60
 
     def run(self):
-        log("Starting feed processing", "INFO")
-        feeds = get_feeds_for_processing(self.num_feeds, self.min_process_interval)
+        log(f"Starting feed processing as {self.worker_id}", "INFO")
+        feeds = claim_feeds_for_processing(self.worker_id, self.num_feeds, self.lease)
         log("Database query completed", "INFO")
 
         total_feeds = len(feeds)
@@ -102,98 +353,377 @@ class FeedProcessor:
             return
         log(f"Found {total_feeds} feeds for processing", "INFO")
 
-        # TODO: this could be done in parallel
-        for feed in feeds:
-            self.process(feed)
+        with self.pools() as executor:
+            futures = {self.submit(executor, feed): feed for feed in feeds}
+            for future in as_completed(futures):
+                # drop the finished download (body and entries) right away
+                self.process(futures.pop(future), future)
+                if self.writer.feeds >= self.commit_every:
+                    self.flush()
+                self.renew_claims()
+        self.report()
+
+    @contextmanager
+    def pools(self):
+        # workers are started from the download threads, where forking
+        # the interpreter isn't safe
+        with (
+            ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ignore_stop_signals,
+            ) as parser_pool,
+            ThreadPoolExecutor(max_workers=self.concurrency) as executor,
+        ):
+            self.parser_pool = parser_pool
+            try:
+                yield executor
+            finally:
+                # the claims are released even if the last writes are lost,
+                # so other processors don't wait for the lease to expire
+                try:
+                    if not self.retrying(self.flush, attempts=SHUTDOWN_ATTEMPTS):
+                        log(f"Lost the results of {self.writer.feeds} feeds", "ERROR")
+                finally:
+                    self.retrying(
+                        release_claims, self.worker_id, attempts=SHUTDOWN_ATTEMPTS
+                    )
+                    self.parser_pool = None
+        POOL.close()
+
+    def flush(self):
+        if self.writer.feeds == 0:
+            return
+        started_at = time.monotonic()
+        self.writer.flush()
+        self.metrics.observe_flush(time.monotonic() - started_at)
 
-    def process(self, feed):
+    def renew_claims(self):
+        """Keeps the claims of feeds waiting or in flight from expiring"""
+        if time.monotonic() - self.renewed_at < self.lease / 3:
+            return
+        renew_claims(self.worker_id, self.lease + self.lookahead)
+        self.renewed_at = time.monotonic()
+
+    def report(self):
+        log(f"Summary: {self.metrics.summary()}", "INFO")
+        self.write_metrics()
+
+    def write_metrics(self):
+        if self.metrics_file:
+            self.metrics.write_textfile(self.metrics_file)
+
+    def serve(self):
+        """Daemon mode: keeps processing feeds as they become due.
+
+        Feeds due within the next `lookahead` seconds are loaded from the
+        database in batches of `num_feeds` into a priority queue ordered by
+        due time, and handed to the download pool as their time comes.
+        SIGTERM (or SIGINT) stops new downloads; feeds already in flight
+        are finished and committed before returning."""
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            log(f"Received signal {signum}, finishing feeds in flight", "INFO")
+            stopping.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        log(f"Starting feed processing daemon as {self.worker_id}", "INFO")
+
+        queue = []
+        in_flight = {}
+        started_at = time.monotonic()
+        last_stats_at = started_at
+        processed_at_last_stats = 0
+        try:
+            with self.pools() as executor:
+                while in_flight or not stopping.is_set():
+                    if not stopping.is_set():
+                        if not queue:
+                            self.retrying(self.refill, queue)
+                        now = format_datetime(datetime.utcnow())
+                        while (
+                            queue
+                            and queue[0][0] <= now
+                            and len(in_flight) < self.concurrency
+                        ):
+                            _, _, feed = heapq.heappop(queue)
+                            in_flight[self.submit(executor, feed)] = feed
+
+                    if in_flight:
+                        done, _ = wait(
+                            in_flight, timeout=1, return_when=FIRST_COMPLETED
+                        )
+                        for future in done:
+                            self.process(in_flight.pop(future), future)
+                        if self.writer.feeds >= self.commit_every or not in_flight:
+                            self.retrying(self.flush)
+                    else:
+                        stopping.wait(self.seconds_until_due(queue))
+                    self.retrying(self.renew_claims)
+
+                    if time.monotonic() - last_stats_at >= self.stats_every:
+                        elapsed = time.monotonic() - last_stats_at
+                        throughput = (self.processed - processed_at_last_stats) / (
+                            elapsed / 60
+                        )
+                        log(
+                            f"Processed {self.processed} feeds ({throughput:.1f}/min), "
+                            f"queue depth {len(queue)}, in flight {len(in_flight)}",
+                            "INFO",
+                        )
+                        last_stats_at = time.monotonic()
+                        processed_at_last_stats = self.processed
+                        self.write_metrics()
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        uptime = (time.monotonic() - started_at) / 60
+        log(
+            f"Stopped after processing {self.processed} feeds in {uptime:.1f} minutes",
+            "INFO",
+        )
+        self.report()
+
+    def retrying(self, action, *args, attempts=1):
+        """Runs a database step, up to `attempts` times while the database
+        stays locked or busy. In the daemon loop a failed step is left for
+        the next pass: buffered writes are kept, claims are renewed and
+        feeds loaded then. Returns whether it succeeded"""
+        for attempt in range(1, attempts + 1):
+            try:
+                action(*args)
+                return True
+            except sqlite3.OperationalError as e:
+                log(
+                    f"Database error in {action.__name__} ({attempt}/{attempts}): {e}",
+                    "WARNING",
+                )
+        return False
+
+    def seconds_until_due(self, queue):
+        if not queue:
+            return self.idle_sleep
+        if not queue[0][0]:
+            return 0
+        due = datetime.fromisoformat(queue[0][0]) - datetime.utcnow()
+        return min(max(due.total_seconds(), 0), self.idle_sleep)
+
+    def refill(self, queue):
+        """Claims the feeds due soon. Feeds in flight or processed but not
+        committed yet are still claimed, so they aren't loaded again"""
+        feeds = claim_feeds_for_processing(
+            self.worker_id,
+            self.num_feeds,
+            self.lease + self.lookahead,
+            lookahead=self.lookahead,
+        )
+        for feed in feeds:
+            heapq.heappush(queue, (feed["next_check_at"] or "", feed["id"], feed))
+
+    def submit(self, executor, feed):
+        started_at = time.monotonic()
+        # the guids the feed most likely still lists, so the parse stage
+        # can skip them without cleaning their content
+        known_guids = get_recent_guids(feed["id"], RECENT_GUIDS)
+        stats = {"url": feed["feed_url"], "db": time.monotonic() - started_at}
+        self.stats[feed["id"]] = stats
+        return executor.submit(self.download, feed, known_guids, stats)
+
+    def download(self, feed, known_guids, stats):
+        """Runs on a worker thread; must not touch the database.
+
+        Returns the http response, the hash of its body and, if there was
+        something new to read, the entry records produced by `parse_feed`.
+        Phase timings and the body size are added to `stats`, which the
+        main thread only reads once the download is done."""
+        with self.host_limiter.get(feed["feed_url"]):
+            response = fetch(
+                feed["feed_url"],
+                etag=feed["etag"],
+                modified=feed["modified"],
+                max_bytes=self.max_bytes,
+                truncate=True,
+                timings=stats,
+            )
+        stats["bytes"] = len(response.body)
+        if status_not_modified(response) or status_nok(response):
+            return response, None, None
+
+        body_hash = hashlib.sha256(response.body).hexdigest()
+        if body_hash == feed["body_hash"]:
+            return response, body_hash, None
+
+        # lets feedparser resolve relative links against the feed url
+        response.headers.setdefault("content-location", response.url)
+        parsed = self.parser_pool.submit(
+            parse_feed,
+            response.body,
+            response.headers,
+            save_content=self.save_content,
+            known_guids=known_guids,
+            max_entries=self.max_entries,
+            stream=response.truncated or len(response.body) > STREAM_ABOVE,
+            truncated=response.truncated,
+        ).result()
+        stats["parse"] = parsed["parse_seconds"]
+        stats["clean"] = parsed["clean_seconds"]
+        return response, body_hash, parsed
+
+    def process(self, feed, future):
         log(
             f"Processing {feed['feed_url']}, last checked: {feed['last_checked_at']}",
             "INFO",
         )
-        mark_feed_checked(feed["id"])
-        try:
-            parsed = parse_with_timeout(feed["feed_url"], timeout=30)
-            if parsed is None:
-                log(f"Feed parsing timed out after 30 seconds", "ERROR")
-                pause_feed_processing(feed["id"])
-                return
-        except Exception as e:
-            log(f"Unhandled feedparser exception: {e}", "ERROR")
-            return
+        stats = self.stats.pop(feed["id"])
+        started_at = time.monotonic()
+        self.writer.mark_checked(feed["id"])
+        new_entries = self.handle(feed, future, stats)
+        self.schedule(feed, new_entries)
+        self.processed += 1
+
+        stats["db"] += time.monotonic() - started_at
+        self.metrics.record(stats)
+        timings = ", ".join(
+            f"{phase} {stats[phase]:.3f}s" for phase in PHASES if phase in stats
+        )
+        log(f"Timings: {timings}", "INFO")
 
-        # Check for bozo first as requests that are unable to complete
-        # have no status information. see feedparser/http.py::get
-        if parsed.bozo == 1:
+    def schedule(self, feed, new_entries):
+        """new_entries is None when the check failed"""
+        if new_entries is None:
+            self.schedule_retry(feed)
+            return
+        post_dates = [entry["date"] for entry in new_entries]
+        post_dates += get_recent_post_dates(feed["id"], HISTORY_SIZE)
+        self.writer.schedule(feed["id"], next_check_at(post_dates), 0)
+
+    def schedule_retry(self, feed):
+        """Failing feeds are retried with an exponential backoff, and only
+        paused once they have been failing for DEAD_ERROR_STREAK checks"""
+        error_streak = feed["error_streak"] + 1
+        retry_at = retry_after(error_streak)
+        self.writer.schedule(feed["id"], retry_at, error_streak, retry_at)
+        if error_streak >= DEAD_ERROR_STREAK:
+            log(f"Pausing feed after {error_streak} failed checks in a row", "ERROR")
+            self.writer.pause(feed["id"])
+        else:
             log(
-                f"Malformed feed or incomplete request: {parsed.bozo_exception}",
-                "ERROR",
+                f"Check failed {error_streak} times in a row, retrying at {retry_at}",
+                "INFO",
             )
-            pause_feed_processing(feed["id"])
-            return
-
-        if status_nok(parsed):
-            log(f"Couldn't download feed: {parsed.status}", "ERROR")
-            pause_feed_processing(feed["id"])
-            return
-
-        feed_title = get_feed_title(parsed.feed)
-        log(f"Feed title: {feed_title}", "INFO")
-        log(f"Feed items: {len(parsed.entries)}", "INFO")
-        latest_guid = None
-
-        if len(parsed.entries) <= 0:
-            log("    Skipping feed. No feed items found.", "ERROR")
-            return
 
-        for entry in parsed.entries:
-            entry_title = get_entry_title(entry)
-            entry_url = get_entry_url(entry)
-            entry_guid = get_entry_guid(entry)
-            entry_date = get_entry_date(entry)
+    def handle(self, feed, future, stats):
+        """Returns the feed's new entries, or None if the check failed.
+        The outcome of the check and entry counts are added to `stats`"""
+        try:
+            response, body_hash, parsed = future.result()
+        except FetchTimeout as e:
+            log(f"Feed download {e}", "ERROR")
+            stats["outcome"] = "timeout"
+            return None
+        except FetchError as e:
+            log(f"Incomplete request: {e}", "ERROR")
+            stats["outcome"] = "fetch_error"
+            return None
+        except Exception as e:
+            log(f"Unhandled feed processing exception: {e}", "ERROR")
+            stats["outcome"] = "exception"
+            return None
 
-            entry_author = get_entry_author(entry)
+        if status_not_modified(response):
+            log("Feed not modified since last check", "INFO")
+            stats["outcome"] = "not_modified"
+            return []
+
+        if status_nok(response):
+            log(f"Couldn't download feed: {response.status}", "ERROR")
+            stats["outcome"] = "http_error"
+            if response.status == 410:
+                log("Pausing feed, the server says it is gone for good", "ERROR")
+                self.writer.pause(feed["id"])
+            return None
 
-            if self.save_content:
-                entry_content = get_entry_content(entry)
+        if body_hash == feed["body_hash"]:
+            log("Feed body unchanged since last check", "INFO")
+            stats["outcome"] = "body_unchanged"
+            return []
 
-                if len(entry_content) != 0:
-                    entry_content = clean_content(entry_content)
-                # TODO: if the entry content lenght is zero we could try
-                # TODO: to download it from the entry_url
-            else:
-                entry_content = None
+        stats["entries"] = parsed["total_entries"]
+        stats["known_entries"] = parsed["known_entries"]
+        if parsed["bozo"]:
+            log(f"Malformed feed: {parsed['bozo_exception']}", "ERROR")
+            stats["outcome"] = "malformed"
+            return None
 
-            if not entry_date or not entry_url:
+        log(f"Feed title: {parsed['title']}", "INFO")
+        log(f"Feed items: {parsed['total_entries']}", "INFO")
+        if parsed["truncated"]:
+            reason = TRUNCATION_REASONS[parsed["truncated"]]
+            log(f"Feed truncated: {reason}", "WARNING")
+        new_entries = []
+
+        validators = [
+            response.etag,
+            response.modified,
+            body_hash,
+            parsed["entries_hash"],
+        ]
+        # a valid feed without posts (yet, or anymore) was still checked
+        if parsed["total_entries"] <= 0:
+            log("Feed has no items", "INFO")
+            stats["outcome"] = "no_entries"
+            self.writer.set_validators(feed["id"], *validators)
+            return new_entries
+
+        if parsed["entries_hash"] == feed["entries_hash"]:
+            log("Feed entries unchanged since last check", "INFO")
+            stats["outcome"] = "entries_unchanged"
+            self.writer.set_validators(feed["id"], *validators)
+            return []
+
+        candidates = []
+        for entry in parsed["entries"]:
+            if not entry["date"] or not entry["url"]:
                 log(
-                    f"    Skipping {entry_url} ({entry_date}). Invalid link or publication date.",
+                    f"    Skipping {entry['url']} ({entry['date']}). Invalid link or publication date.",
                     "ERROR",
                 )
                 continue
+            candidates.append(entry)
 
-            # if we find the latest registered guid, it means
-            # from here on entries were already processed
-            if feed["last_post_guid"] == entry_guid:
-                log("Feed already up to date - no new entries", "INFO")
-                break
-
-            if latest_guid is None:
-                latest_guid = entry_guid
-
-            log(f"    {entry_url} ({entry_date})", "INFO")
-            insert_feed_item(
+        # entries might be reordered or older than the recent guids the
+        # parse stage knew about, so check them all at once
+        seen = get_known_guids(feed["id"], [entry["guid"] for entry in candidates])
+        for entry in candidates:
+            if entry["guid"] in seen:
+                continue
+            seen.add(entry["guid"])
+            new_entries.append(entry)
+            log(f"    {entry['url']} ({entry['date']})", "INFO")
+            self.writer.add_item(
                 feed["id"],
-                entry_title,
-                entry_url,
-                entry_guid,
-                entry_date,
-                entry_author,
-                entry_content,
+                entry["title"],
+                entry["url"],
+                entry["guid"],
+                entry["date"],
+                entry["author"],
+                entry["content"],
             )
 
-        if latest_guid is None:
+        stats["new_entries"] = len(new_entries)
+        stats["outcome"] = "new_entries" if new_entries else "up_to_date"
+        if not new_entries:
+            log("Feed already up to date - no new entries", "INFO")
+
+        self.writer.set_validators(feed["id"], *validators)
+
+        if parsed["head_guid"] is None:
             log("    latest_guid wasn't set.", "ERROR")
-            return
+            return new_entries
 
-        latest_feed_item_id = get_id_from_guid(feed["id"], latest_guid)
-        update_feed_latest(feed["id"], latest_guid, latest_feed_item_id)
+        self.writer.set_latest(feed["id"], parsed["head_guid"])
+        return new_entries
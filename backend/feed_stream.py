@@ -0,0 +1,155 @@
+"""Incremental RSS/Atom reader for feeds too big for feedparser.
+
+feedparser builds the whole document (every entry, with its full html
+content) before returning anything. Here entries are extracted one at a
+time with an XMLPullParser and discarded right after, so memory stays
+bounded by the entry being read and the caller can stop at any point.
+Only the fields FeedProcessor stores are extracted, normalized the same
+way feedparser does it so guids don't change between both parsers."""
+
+from datetime import datetime
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+# feedparser's date parser, so published dates match parse_feed's
+from feedparser.datetimes import _parse_date
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+RSS1 = "{http://purl.org/rss/1.0/}"
+CONTENT = "{http://purl.org/rss/1.0/modules/content/}"
+DC = "{http://purl.org/dc/elements/1.1/}"
+XML_BASE = "{http://www.w3.org/XML/1998/namespace}base"
+
+ENTRY_TAGS = ("item", RSS1 + "item", ATOM + "entry")
+FEED_TAGS = ("channel", RSS1 + "channel", ATOM + "feed")
+TITLE_TAGS = ("title", RSS1 + "title", ATOM + "title")
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamParseError(Exception):
+    pass
+
+
+def text(element, path):
+    value = element.findtext(path)
+    return value.strip() if value else None
+
+
+def with_base(base_url, element):
+    """`base_url` as changed by the element's xml:base, if it has one"""
+    xml_base = element.get(XML_BASE) if element is not None else None
+    return urljoin(base_url, xml_base) if xml_base else base_url
+
+
+def parse_date(value):
+    if not value:
+        return None
+    parsed = _parse_date(value)
+    if parsed is None:
+        return None
+    return datetime(*parsed[:6]).isoformat()
+
+
+def inner_xml(element):
+    """xhtml atom content lives in a wrapping div, feedparser drops it"""
+    children = list(element)
+    if len(children) == 1 and children[0].tag.endswith("}div"):
+        element = children[0]
+    parts = [element.text or ""]
+    for child in element:
+        parts.append(ElementTree.tostring(child, encoding="unicode"))
+    return "".join(parts).strip()
+
+
+def rss_entry(item, base_url):
+    ns = RSS1 if item.tag.startswith(RSS1) else ""
+    link = text(item, ns + "link")
+    link_base = with_base(base_url, item.find(ns + "link"))
+    guid = item.find("guid")
+    guid_value = guid.text.strip() if guid is not None and guid.text else None
+    if guid_value and guid.get("isPermaLink", "true").lower() != "false":
+        guid_value = urljoin(with_base(base_url, guid), guid_value)
+        link = link or guid_value
+    link = urljoin(link_base, link) if link else None
+    return {
+        "title": text(item, ns + "title"),
+        "url": link,
+        "guid": guid_value or link,
+        "date": parse_date(text(item, "pubDate")),
+        "author": text(item, "author") or text(item, DC + "creator"),
+        "content": text(item, CONTENT + "encoded"),
+    }
+
+
+def atom_author(entry):
+    """Like feedparser: name (email), or whichever of both is there"""
+    author = entry.find(ATOM + "author")
+    if author is None:
+        return None
+    name = text(author, ATOM + "name")
+    email = text(author, ATOM + "email")
+    if name and email:
+        return f"{name} ({email})"
+    return name or email
+
+
+def atom_entry(entry, base_url):
+    link = None
+    for element in entry.iter(ATOM + "link"):
+        if element.get("rel", "alternate") == "alternate":
+            link = element.get("href")
+            link = urljoin(with_base(base_url, element), link) if link else None
+            break
+    entry_id = text(entry, ATOM + "id")
+    id_base = with_base(base_url, entry.find(ATOM + "id"))
+    content = entry.find(ATOM + "content")
+    if content is not None and content.get("type") == "xhtml":
+        content = inner_xml(content)
+    elif content is not None:
+        content = (content.text or "").strip()
+    return {
+        "title": text(entry, ATOM + "title"),
+        "url": link,
+        "guid": urljoin(id_base, entry_id) if entry_id else link,
+        "date": parse_date(text(entry, ATOM + "published")),
+        "author": atom_author(entry),
+        "content": content,
+    }
+
+
+def iter_feed(body, base_url):
+    """Yields ("title", feed_title) once the feed title is read, then
+    ("entry", record) for every entry in document order.
+
+    body may be cut short (see fetcher.fetch's truncate); entries that
+    were complete before the cut are still yielded. Raises
+    StreamParseError if the document isn't well-formed XML."""
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    stack = []
+    # base url of every open element, xml:base included
+    bases = []
+    for start in range(0, len(body), CHUNK_SIZE):
+        try:
+            parser.feed(body[start : start + CHUNK_SIZE])
+            events = list(parser.read_events())
+        except ElementTree.ParseError as e:
+            raise StreamParseError(str(e)) from e
+        for event, element in events:
+            if event == "start":
+                stack.append(element)
+                bases.append(with_base(bases[-1] if bases else base_url, element))
+                continue
+            stack.pop()
+            element_base = bases.pop()
+            if element.tag in ENTRY_TAGS:
+                if element.tag == ATOM + "entry":
+                    yield "entry", atom_entry(element, element_base)
+                else:
+                    yield "entry", rss_entry(element, element_base)
+                # drop the entry (and its content) once it was read
+                element.clear()
+                if stack:
+                    stack[-1].remove(element)
+            elif element.tag in TITLE_TAGS and stack and stack[-1].tag in FEED_TAGS:
+                yield "title", (element.text or "").strip()
@@ -0,0 +1,572 @@
+import base64
+import http.client
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import urllib.request
+import zlib
+from urllib.parse import unquote, urljoin, urlsplit
+
+import brotli
+import feedparser
+
+USER_AGENT = os.getenv("USER_AGENT", feedparser.USER_AGENT)
+ACCEPT = feedparser.http.ACCEPT_HEADER
+ACCEPT_ENCODING = "gzip, deflate, br"
+DECODE_ERRORS = (zlib.error, brotli.error)
+
+# seconds allowed to open the connection (tcp + tls handshake)
+CONNECT_TIMEOUT = 10
+# seconds allowed between two reads from the socket
+READ_TIMEOUT = 15
+# seconds allowed for the whole request, redirects included
+TOTAL_TIMEOUT = 30
+# largest (decompressed) body we accept, in bytes
+MAX_BYTES = 10 * 1024 * 1024
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+
+# keep-alive connections left idle, per server address and in total, and
+# for how long
+MAX_IDLE_CONNECTIONS = 4
+MAX_IDLE_TOTAL = 64
+IDLE_TIMEOUT = 30
+# seconds a dns answer is reused
+DNS_TTL = 300
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class FetchError(Exception):
+    """The request couldn't complete (dns, connection, tls, ...)"""
+
+
+class FetchTimeout(FetchError):
+    pass
+
+
+class FetchTooLarge(FetchError):
+    pass
+
+
+class FetchResult:
+    def __init__(self, url, status, headers, body, truncated=False):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.truncated = truncated
+
+    @property
+    def etag(self):
+        return self.headers.get("etag")
+
+    @property
+    def modified(self):
+        return self.headers.get("last-modified")
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        remaining = self.expires_at - time.monotonic()
+        if remaining <= 0:
+            raise FetchTimeout(f"timed out after {self.seconds} seconds")
+        return remaining
+
+    def timeout(self, step_timeout):
+        """Socket timeout for the next blocking step"""
+        return min(step_timeout, self.remaining())
+
+
+class BrotliDecoder:
+    """zlib.decompressobj's interface over brotli.Decompressor (1.2 and
+    later, older versions can't bound the decompressed size)"""
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data, max_length):
+        # once the output reaches max_length the body is over max_bytes
+        # and read_body stops, so leftover input never has to be drained
+        return self.decompressor.process(data, output_buffer_limit=max_length)
+
+    def flush(self):
+        return b""
+
+
+def get_decoder(encoding):
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "br":
+        return BrotliDecoder()
+    return None
+
+
+def read_body(response, sock, deadline, max_bytes, truncate):
+    """Reads the response in chunks so the total deadline and size
+    limit are enforced while the body streams in, not after.
+
+    Returns the body and whether it was cut at max_bytes, which only
+    happens if `truncate` is set; otherwise FetchTooLarge is raised."""
+    decoder = get_decoder(response.getheader("content-encoding", "").lower())
+    chunks = []
+    size = 0
+    while True:
+        sock.settimeout(deadline.timeout(READ_TIMEOUT))
+        # read1 returns whatever arrived, read() would keep waiting for a
+        # full chunk and let a slow-drip server stretch past the deadline
+        chunk = response.read1(CHUNK_SIZE)
+        if not chunk:
+            break
+        if decoder is not None:
+            # bound the decompressed size too, compressed bodies can be tiny
+            chunk = decoder.decompress(chunk, max_bytes - size + 1)
+        size += len(chunk)
+        if size > max_bytes:
+            if not truncate:
+                raise FetchTooLarge(f"response larger than {max_bytes} bytes")
+            chunks.append(chunk[: len(chunk) - (size - max_bytes)])
+            return b"".join(chunks), True
+        chunks.append(chunk)
+    if decoder is not None:
+        chunks.append(decoder.flush())
+    return b"".join(chunks), False
+
+
+def add_time(timings, phase, started_at):
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + time.monotonic() - started_at
+
+
+def drain(response, sock, deadline):
+    """Reads a small body we don't need, so the connection can be reused"""
+    if response.length is None or response.length > CHUNK_SIZE:
+        return False
+    sock.settimeout(deadline.timeout(READ_TIMEOUT))
+    response.read()
+    return True
+
+
+def certificate_matches(cert, host):
+    """Whether a server certificate is valid for `host`, wildcards included"""
+    host = host.lower()
+    for kind, name in cert.get("subjectAltName", ()):
+        name = name.lower()
+        if kind != "DNS":
+            continue
+        if name == host:
+            return True
+        if name.startswith("*.") and host.partition(".")[2] == name[2:]:
+            return True
+    return False
+
+
+def get_proxy(url):
+    """The proxy `url` is fetched through, split, or None: from the
+    http_proxy, https_proxy and no_proxy environment variables, like
+    urllib and requests do. Only http proxies are supported"""
+    parts = urlsplit(url)
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.netloc.rpartition("@")[2]):
+        return None
+    if "://" not in proxy:
+        proxy = f"http://{proxy}"
+    proxy = urlsplit(proxy)
+    if proxy.scheme != "http":
+        raise FetchError(f"unsupported proxy scheme: {proxy.scheme}")
+    return proxy
+
+
+def proxy_headers(proxy):
+    if proxy.username is None:
+        return {}
+    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+    return {
+        "Proxy-Authorization": "Basic "
+        + base64.b64encode(credentials.encode()).decode("ascii")
+    }
+
+
+# shared by all connections, loading the ca certificates is expensive
+SSL_CONTEXT = ssl.create_default_context()
+
+
+class HTTPConnection(http.client.HTTPConnection):
+    """Connects to an already resolved address, so connections can be
+    pooled by address and shared by the hosts it serves.
+
+    With a `proxy`, the address is the proxy's: plain http requests are
+    sent to it with the whole url, https ones through a CONNECT tunnel
+    to `host`"""
+
+    scheme = "http"
+
+    def __init__(self, host, port, address, timeout, proxy=None):
+        super().__init__(host, port, timeout=timeout)
+        self.address = address
+        self.proxy = proxy
+        self.idle_since = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def can_serve(self, host):
+        # a plain http connection can carry requests for any virtual host
+        return True
+
+    def send_get(self, url, headers):
+        if self.proxy is None:
+            self.request("GET", request_path(url), headers=headers)
+            return
+        # the absolute url, without the credentials it may carry
+        parts = urlsplit(url)
+        target = f"http://{parts.netloc.rpartition('@')[2]}{request_path(url)}"
+        headers = dict(headers, **proxy_headers(self.proxy))
+        self.request("GET", target, headers=headers)
+
+
+class HTTPSConnection(HTTPConnection):
+    scheme = "https"
+
+    def __init__(self, host, port, address, timeout, proxy=None):
+        super().__init__(host, port, address, timeout, proxy)
+        if proxy is not None:
+            self.set_tunnel(host, port, headers=proxy_headers(proxy))
+
+    def connect(self):
+        super().connect()
+        if self.proxy is not None:
+            # sends the CONNECT set up by set_tunnel, as
+            # http.client.HTTPConnection.connect does
+            self._tunnel()
+        self.sock = SSL_CONTEXT.wrap_socket(self.sock, server_hostname=self.host)
+
+    def can_serve(self, host):
+        # over tls, only hosts the certificate is valid for, like the
+        # subdomains of shared platforms under a wildcard certificate;
+        # a tunnel only leads to the host it was opened for
+        if host == self.host:
+            return True
+        return self.proxy is None and certificate_matches(self.sock.getpeercert(), host)
+
+    def send_get(self, url, headers):
+        self.request("GET", request_path(url), headers=headers)
+
+
+class ConnectionPool:
+    """Keep-alive connections shared by all fetches (and threads).
+
+    Idle connections are kept per server address, and reused for any
+    host resolving to that address the connection is valid for, so feeds
+    of many blogs hosted on the same platform share a few connections
+    instead of paying a tcp and tls handshake each. Connections idle for
+    longer than IDLE_TIMEOUT are closed on the next get or put, and the
+    least recently used ones once more than MAX_IDLE_TOTAL are idle."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.addresses = {}
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.addresses.get((host, port))
+        if cached and now - cached[1] < DNS_TTL:
+            return cached[0]
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(info[4][:2] for info in infos))
+        with self.lock:
+            self.addresses[(host, port)] = (addresses, now)
+        return addresses
+
+    def get(self, url, deadline, reuse=True):
+        """Returns an idle connection that can serve `url` (unless `reuse`
+        is off), or a new one, and whether it was reused. Connections to
+        a proxy (see get_proxy) are pooled by the proxy's address"""
+        parts = urlsplit(url)
+        if parts.scheme == "https":
+            connection_class = HTTPSConnection
+        elif parts.scheme == "http":
+            connection_class = HTTPConnection
+        else:
+            raise FetchError(f"unsupported url scheme: {parts.scheme}")
+        host = parts.hostname
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        proxy = get_proxy(url)
+
+        if proxy is None:
+            addresses = self.resolve(host, port)
+        else:
+            addresses = self.resolve(proxy.hostname, proxy.port or 80)
+        if reuse:
+            conn = self.take_idle(parts.scheme, addresses, host, proxy)
+            if conn is not None:
+                return conn, True
+
+        error = None
+        for address in addresses:
+            conn = connection_class(
+                host,
+                port,
+                address,
+                timeout=deadline.timeout(CONNECT_TIMEOUT),
+                proxy=proxy,
+            )
+            try:
+                conn.connect()
+                return conn, False
+            except OSError as e:
+                conn.close()
+                error = e
+        raise error
+
+    def take_idle(self, scheme, addresses, host, proxy):
+        found = None
+        with self.lock:
+            stale = self.sweep()
+            for address in addresses:
+                conns = self.idle.get((scheme, address), [])
+                # most recently used first, the least likely to be closed
+                for conn in reversed(conns[:]):
+                    # readable while idle: the server closed it
+                    if is_readable(conn.sock):
+                        conns.remove(conn)
+                        stale.append(conn)
+                    elif conn.proxy == proxy and conn.can_serve(host):
+                        conns.remove(conn)
+                        found = conn
+                        break
+                if found is not None:
+                    break
+        for conn in stale:
+            conn.close()
+        return found
+
+    def put(self, conn):
+        key = (conn.scheme, conn.address)
+        conn.idle_since = time.monotonic()
+        with self.lock:
+            stale = self.sweep()
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < MAX_IDLE_CONNECTIONS:
+                conns.append(conn)
+                stale.extend(self.evict(MAX_IDLE_TOTAL))
+            else:
+                stale.append(conn)
+        for conn in stale:
+            conn.close()
+
+    def sweep(self):
+        """Takes the connections idle for longer than IDLE_TIMEOUT out of
+        the pool, to be closed once the lock is released"""
+        now = time.monotonic()
+        expired = []
+        for key, conns in list(self.idle.items()):
+            expired.extend(
+                conn for conn in conns if now - conn.idle_since > IDLE_TIMEOUT
+            )
+            conns[:] = [conn for conn in conns if now - conn.idle_since <= IDLE_TIMEOUT]
+            if not conns:
+                del self.idle[key]
+        return expired
+
+    def evict(self, limit):
+        """Takes the least recently used connections out of the pool
+        until at most `limit` are left"""
+        conns = sorted(
+            (conn for conns in self.idle.values() for conn in conns),
+            key=lambda conn: conn.idle_since,
+        )
+        evicted = conns[: max(0, len(conns) - limit)]
+        for conn in evicted:
+            key = (conn.scheme, conn.address)
+            self.idle[key].remove(conn)
+            if not self.idle[key]:
+                del self.idle[key]
+        return evicted
+
+    def close(self):
+        with self.lock:
+            conns = self.evict(0)
+        for conn in conns:
+            conn.close()
+
+
+def is_readable(sock):
+    """Whether `sock` has data (or eof) waiting. poll, unlike select,
+    takes any file descriptor, however high"""
+    if sock is None:
+        return True
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(0))
+
+
+POOL = ConnectionPool()
+
+
+def count(timings, key):
+    if timings is not None:
+        timings[key] = timings.get(key, 0) + 1
+
+
+def send_request(url, headers, deadline, timings):
+    """Sends the request on a pooled connection when there is one.
+
+    A reused connection that turns out to be closed by the server, or
+    that the server won't answer this host on (421), is replaced by a
+    new connection once. Returns the connection, its socket and the
+    response."""
+    parts = urlsplit(url)
+    headers = dict(headers, Host=parts.netloc.rpartition("@")[2])
+    reuse = True
+    while True:
+        started_at = time.monotonic()
+        try:
+            conn, reused = POOL.get(url, deadline, reuse=reuse)
+        finally:
+            add_time(timings, "connect", started_at)
+        count(timings, "reused_connections" if reused else "new_connections")
+
+        started_at = time.monotonic()
+        # http.client drops conn.sock once it knows the server will
+        # close the connection, the response keeps reading from it
+        sock = conn.sock
+        try:
+            sock.settimeout(deadline.timeout(READ_TIMEOUT))
+            conn.send_get(url, headers)
+            response = conn.getresponse()
+        except (ConnectionError, ssl.SSLEOFError):
+            conn.close()
+            if not reused:
+                raise
+            reuse = False
+            continue
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            add_time(timings, "download", started_at)
+
+        if response.status == 421 and reused:
+            response.close()
+            conn.close()
+            reuse = False
+            continue
+        return conn, sock, response
+
+
+def request_path(url):
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return path
+
+
+def fetch(
+    url,
+    etag=None,
+    modified=None,
+    timeout=TOTAL_TIMEOUT,
+    max_bytes=MAX_BYTES,
+    truncate=False,
+    timings=None,
+    follow_redirects=True,
+):
+    """Downloads `url` and returns its raw (decompressed) bytes.
+
+    Connecting, each read and the request as a whole are bounded by
+    CONNECT_TIMEOUT, READ_TIMEOUT and `timeout`, enforced on the socket
+    itself; the connection is closed as soon as any of them runs out.
+
+    Bodies larger than max_bytes raise FetchTooLarge, or with `truncate`
+    are cut at max_bytes and returned with `truncated` set.
+
+    etag and modified are sent back as If-None-Match and If-Modified-Since,
+    unless a redirect leads to another host; a 304 answer is returned as
+    a FetchResult with an empty body.
+
+    Without `follow_redirects`, a redirect is returned as it is, with an
+    empty body: the caller checks where it leads before following it.
+
+    Connections are kept alive and reused across fetches, see
+    ConnectionPool, and go through the proxy the environment sets, see
+    get_proxy.
+
+    If `timings` is a dict, the seconds spent connecting and downloading
+    (redirects included) are added to its "connect" and "download" keys,
+    even when the request fails, and the connections used are counted
+    in "new_connections" and "reused_connections"."""
+    deadline = Deadline(timeout)
+    headers = {
+        "User-Agent": USER_AGENT,
+        "Accept": ACCEPT,
+        "Accept-Encoding": ACCEPT_ENCODING,
+    }
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+
+    for _ in range(MAX_REDIRECTS + 1):
+        conn = None
+        response = None
+        reusable = False
+        started_at = None
+        try:
+            conn, sock, response = send_request(url, headers, deadline, timings)
+            started_at = time.monotonic()
+            response_headers = {k.lower(): v for k, v in response.getheaders()}
+
+            location = response_headers.get("location")
+            if follow_redirects and response.status in REDIRECT_STATUSES and location:
+                redirected = urljoin(url, location)
+                if urlsplit(redirected).hostname != urlsplit(url).hostname:
+                    # the validators came from the original host
+                    headers.pop("If-None-Match", None)
+                    headers.pop("If-Modified-Since", None)
+                url = redirected
+                reusable = drain(response, sock, deadline)
+                continue
+            if response.status >= 300:
+                reusable = drain(response, sock, deadline)
+                return FetchResult(url, response.status, response_headers, b"")
+
+            body, truncated = read_body(response, sock, deadline, max_bytes, truncate)
+            reusable = not truncated
+        except FetchError:
+            raise
+        except (socket.timeout, TimeoutError) as e:
+            raise FetchTimeout("timed out waiting for the server") from e
+        except DECODE_ERRORS as e:
+            raise FetchError(f"couldn't decompress response: {e}") from e
+        except (OSError, http.client.HTTPException) as e:
+            raise FetchError(str(e) or type(e).__name__) from e
+        finally:
+            if started_at is not None:
+                add_time(timings, "download", started_at)
+            if response is not None:
+                response.close()
+            if conn is not None:
+                if reusable and conn.sock is not None and not response.will_close:
+                    POOL.put(conn)
+                else:
+                    conn.close()
+
+        # feedparser would report the bytes as plain text otherwise
+        response_headers.pop("content-encoding", None)
+        return FetchResult(url, response.status, response_headers, body, truncated)
+
+    raise FetchError(f"more than {MAX_REDIRECTS} redirects")
@@ -0,0 +1,154 @@
+"""Single pass html to text extraction.
+
+clean_content used to build a whole BeautifulSoup tree for every post
+just to read its text back. TextExtractor gets the same text straight
+from html.parser's tokenizer (the one BeautifulSoup's "html.parser"
+builder uses), keeping only a stack of open tag names instead of a tree.
+
+The output is the same as clean_content's BeautifulSoup version, quirks
+included: whitespace-only strings collapse to a single space or newline
+outside <pre>/<textarea>, text of <script>/<style> is dropped, as well
+as text of <template>/<rt>/<rp> (except CDATA sections), and character
+references are resolved the way BeautifulSoup does."""
+
+import re
+from html.parser import HTMLParser
+
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+# BeautifulSoup's HTMLTreeBuilder defaults
+VOID_TAGS = frozenset(
+    [
+        "area", "base", "basefont", "bgsound", "br", "col", "command",
+        "embed", "frame", "hr", "image", "img", "input", "isindex",
+        "keygen", "link", "menuitem", "meta", "nextid", "param", "source",
+        "spacer", "track", "wbr",
+    ]
+)  # fmt: skip
+PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+# removed from the document along with everything inside them
+DROPPED_TAGS = frozenset(["script", "style"])
+# their strings aren't text, but CDATA sections inside them are
+NON_TEXT_TAGS = frozenset(["template", "rt", "rp"])
+
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+DECIMAL_REFERENCE = re.compile("^([0-9]+)(.*)")
+HEX_REFERENCE = re.compile("^([0-9a-f]+)(.*)")
+
+
+def numeric_reference(name):
+    """Character for `&#name;`, plus any trailing data html.parser
+    handed over as part of an unterminated reference"""
+    base, pattern = 10, DECIMAL_REFERENCE
+    if name[:1] in ("x", "X"):
+        name, base, pattern = name[1:], 16, HEX_REFERENCE
+    try:
+        return UnicodeDammit.numeric_character_reference(int(name, base))[0], ""
+    except ValueError:
+        match = pattern.search(name)
+        if match is None:
+            return "", name
+        number, extra = match.groups()
+        return UnicodeDammit.numeric_character_reference(int(number, base))[0], extra
+
+
+class TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.strings = []
+        self.data = []
+        self.open_tags = []
+        # void tags seen as <br>, a later </br> doesn't end the string
+        self.unclosed_void_tags = []
+        # how many of the open tags are in each of the tag sets above
+        self.dropped = 0
+        self.non_text = 0
+        self.preserving = 0
+
+    def end_data(self, cdata=False):
+        """A string ends, same as BeautifulSoup.endData"""
+        if not self.data:
+            return
+        data = "".join(self.data)
+        self.data = []
+        if not self.preserving and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+        if not self.dropped and (cdata or not self.non_text):
+            self.strings.append(data)
+
+    def count(self, tag, step):
+        if tag in DROPPED_TAGS:
+            self.dropped += step
+        elif tag in NON_TEXT_TAGS:
+            self.non_text += step
+        elif tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserving += step
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        if tag in VOID_TAGS:
+            self.unclosed_void_tags.append(tag)
+        else:
+            self.open_tags.append(tag)
+            self.count(tag, 1)
+
+    def handle_startendtag(self, tag, attrs):
+        # <tag/> opens and closes right away, nothing to track
+        self.end_data()
+
+    def handle_endtag(self, tag):
+        if tag in self.unclosed_void_tags:
+            self.unclosed_void_tags.remove(tag)
+            return
+        self.end_data()
+        if tag not in self.open_tags:
+            return
+        # unclosed tags inside `tag` are closed along with it
+        while True:
+            closed = self.open_tags.pop()
+            self.count(closed, -1)
+            if closed == tag:
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        character, extra = numeric_reference(name)
+        self.data.append(character)
+        self.data.append(extra)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.data.append(character if character is not None else f"&{name}")
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith("CDATA["):
+            self.data.append(data[len("CDATA[") :])
+            self.end_data(cdata=True)
+
+    def text(self):
+        self.close()
+        self.end_data()
+        return "".join(self.strings)
+
+
+def html_to_text(html):
+    """Visible text of an html fragment or document, in one line"""
+    parser = TextExtractor()
+    parser.feed(html)
+    text = parser.text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return " ".join(chunk for chunk in chunks if chunk)
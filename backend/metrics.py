@@ -0,0 +1,142 @@
+"""Aggregated FeedProcessor metrics, in the Prometheus text format.
+
+Every processed feed is recorded as a plain dict (see FeedProcessor.process)
+with the seconds spent in each phase, the body size, entry counts and the
+outcome of the check. They are folded into histograms and counters which
+can be written to a textfile for node_exporter's textfile collector, or
+served by the web app's /metrics to scrapers holding METRICS_TOKEN (see
+METRICS_FILE)."""
+
+import os
+import time
+
+# connect: dns, tcp and tls handshakes; download: request until the last
+# byte; parse and clean: on the parse workers; db: database work on the
+# main thread for that feed (commits are timed separately, per flush)
+PHASES = ("connect", "download", "parse", "clean", "db")
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4**i for i in range(8))  # 1KB to 16MB
+ENTRIES_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, 500, 1000)
+
+# how many of the slowest feeds the run summary names
+SLOWEST = 5
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def lines(self, name, labels=""):
+        """Exposition lines; `labels` is 'key="value",' or empty"""
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{{labels}le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{labels}le="+Inf"}} {self.count}'
+        braces = f"{{{labels.rstrip(',')}}}" if labels else ""
+        yield f"{name}_sum{braces} {self.sum}"
+        yield f"{name}_count{braces} {self.count}"
+
+
+class Metrics:
+    def __init__(self):
+        self.phases = {phase: Histogram(SECONDS_BUCKETS) for phase in PHASES}
+        self.feed_seconds = Histogram(SECONDS_BUCKETS)
+        self.flush_seconds = Histogram(SECONDS_BUCKETS)
+        self.response_bytes = Histogram(BYTES_BUCKETS)
+        self.entries = Histogram(ENTRIES_BUCKETS)
+        self.outcomes = {}
+        self.new_entries = 0
+        self.known_entries = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        # (seconds, url) of the slowest feeds recorded
+        self.slowest = []
+        self.started_at = time.monotonic()
+
+    def record(self, stats):
+        total = 0
+        # phases a feed didn't reach (no parse after a 304...) aren't observed
+        for phase in PHASES:
+            if phase in stats:
+                self.phases[phase].observe(stats[phase])
+                total += stats[phase]
+        self.feed_seconds.observe(total)
+        if "bytes" in stats:
+            self.response_bytes.observe(stats["bytes"])
+        if "entries" in stats:
+            self.entries.observe(stats["entries"])
+        self.new_entries += stats.get("new_entries", 0)
+        self.known_entries += stats.get("known_entries", 0)
+        self.new_connections += stats.get("new_connections", 0)
+        self.reused_connections += stats.get("reused_connections", 0)
+        outcome = stats.get("outcome", "unknown")
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+        self.slowest.append((total, stats["url"]))
+        self.slowest.sort(reverse=True)
+        del self.slowest[SLOWEST:]
+
+    def observe_flush(self, seconds):
+        self.flush_seconds.observe(seconds)
+
+    def summary(self):
+        """One line describing everything recorded so far"""
+        feeds = self.feed_seconds.count
+        elapsed = time.monotonic() - self.started_at
+        outcomes = ", ".join(
+            f"{outcome} {count}" for outcome, count in sorted(self.outcomes.items())
+        )
+        phases = ", ".join(f"{phase} {self.phases[phase].sum:.1f}s" for phase in PHASES)
+        slowest = ", ".join(f"{url} {seconds:.1f}s" for seconds, url in self.slowest)
+        megabytes = self.response_bytes.sum / 1024 / 1024
+        return (
+            f"{feeds} feeds in {elapsed:.1f}s ({outcomes}); "
+            f"{megabytes:.1f} MB, {self.new_entries} new entries; "
+            f"{self.new_connections} connections opened, "
+            f"{self.reused_connections} reused; "
+            f"time in {phases}, commits {self.flush_seconds.sum:.1f}s; "
+            f"slowest: {slowest or '-'}"
+        )
+
+    def lines(self):
+        yield "# TYPE brcrawl_feed_phase_seconds histogram"
+        for phase in PHASES:
+            yield from self.phases[phase].lines(
+                "brcrawl_feed_phase_seconds", f'phase="{phase}",'
+            )
+        yield "# TYPE brcrawl_feed_seconds histogram"
+        yield from self.feed_seconds.lines("brcrawl_feed_seconds")
+        yield "# TYPE brcrawl_commit_seconds histogram"
+        yield from self.flush_seconds.lines("brcrawl_commit_seconds")
+        yield "# TYPE brcrawl_feed_response_bytes histogram"
+        yield from self.response_bytes.lines("brcrawl_feed_response_bytes")
+        yield "# TYPE brcrawl_feed_entries histogram"
+        yield from self.entries.lines("brcrawl_feed_entries")
+        yield "# TYPE brcrawl_feeds_processed_total counter"
+        for outcome, count in sorted(self.outcomes.items()):
+            yield f'brcrawl_feeds_processed_total{{outcome="{outcome}"}} {count}'
+        yield "# TYPE brcrawl_feed_entries_total counter"
+        yield f'brcrawl_feed_entries_total{{kind="new"}} {self.new_entries}'
+        yield f'brcrawl_feed_entries_total{{kind="known"}} {self.known_entries}'
+        yield "# TYPE brcrawl_connections_total counter"
+        yield f'brcrawl_connections_total{{reused="false"}} {self.new_connections}'
+        yield f'brcrawl_connections_total{{reused="true"}} {self.reused_connections}'
+        yield "# TYPE brcrawl_feed_processing_last_update_seconds gauge"
+        yield f"brcrawl_feed_processing_last_update_seconds {time.time()}"
+
+    def write_textfile(self, path):
+        """Replaces `path` atomically, so readers never see half a file"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(self.lines()) + "\n")
+        os.replace(tmp_path, path)
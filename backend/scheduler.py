@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+from statistics import median
+
+# interval used while a feed has too little history to estimate its cadence
+DEFAULT_INTERVAL = timedelta(minutes=120)
+MIN_INTERVAL = timedelta(minutes=30)
+MAX_INTERVAL = timedelta(days=3)
+
+# how many times we poll a feed during its typical gap between posts
+CHECKS_PER_POST = 4
+
+# how many recent posts are used to estimate the cadence
+HISTORY_SIZE = 10
+
+# failing feeds are retried after RETRY_INTERVAL, doubled with each
+# consecutive failure up to MAX_RETRY_INTERVAL
+RETRY_INTERVAL = timedelta(minutes=30)
+MAX_RETRY_INTERVAL = timedelta(days=3)
+
+# consecutive failures after which a feed is considered dead and paused,
+# about two weeks of retries
+DEAD_ERROR_STREAK = 12
+
+
+def format_datetime(dt):
+    """Same format as sqlite's DATETIME('now')"""
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def next_check_interval(post_dates, now):
+    """Estimates how long we can wait before polling a feed again.
+
+    post_dates are the feed's most recent publication dates. Feeds are
+    polled a few times per median gap between posts, and get polled less
+    as they go quiet for longer than that gap."""
+    post_dates = sorted(post_dates, reverse=True)[:HISTORY_SIZE]
+
+    if len(post_dates) < 2:
+        interval = DEFAULT_INTERVAL
+    else:
+        gaps = [newer - older for newer, older in zip(post_dates, post_dates[1:])]
+        typical_gap = median(gaps)
+        interval = typical_gap / CHECKS_PER_POST
+        # going quiet: back off with the time since the feed last changed
+        since_last_post = now - post_dates[0]
+        if since_last_post > typical_gap:
+            interval = max(interval, since_last_post / CHECKS_PER_POST)
+
+    return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+
+def next_check_at(post_dates, now=None):
+    """post_dates are iso formatted strings, as stored in feed_items"""
+    now = now or datetime.utcnow()
+    dates = [datetime.fromisoformat(d) for d in post_dates if d]
+    # posts dated in the future would make the feed look hyperactive
+    dates = [d for d in dates if d <= now]
+    return format_datetime(now + next_check_interval(dates, now))
+
+
+def retry_interval(error_streak):
+    """Backoff after `error_streak` consecutive failed checks"""
+    return min(RETRY_INTERVAL * 2 ** (error_streak - 1), MAX_RETRY_INTERVAL)
+
+
+def retry_after(error_streak, now=None):
+    now = now or datetime.utcnow()
+    return format_datetime(now + retry_interval(error_streak))
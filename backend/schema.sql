@@ -123,3 +123,152 @@ INSERT INTO feed_processing_status (name) VALUES ('active'), ('paused');
 
 -- saves feed processing status on feeds table
 ALTER TABLE feeds ADD COLUMN processing_status_id DEFAULT 1;
+
+-- http validators from the last successful poll, sent back as
+-- If-None-Match / If-Modified-Since so unchanged feeds answer 304
+ALTER TABLE feeds ADD COLUMN etag TEXT;
+ALTER TABLE feeds ADD COLUMN modified TEXT;
+
+-- adaptive polling: when each feed is due for its next check, derived from
+-- its posting cadence, and how many checks in a row have failed
+ALTER TABLE feeds ADD COLUMN next_check_at DATETIME;
+ALTER TABLE feeds ADD COLUMN error_streak INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS idx_feeds_next_check_at ON feeds(next_check_at);
+
+-- sha256 of the last processed feed body and of its entry list, to skip
+-- feeds that answer 200 with the same content every time
+ALTER TABLE feeds ADD COLUMN body_hash TEXT;
+ALTER TABLE feeds ADD COLUMN entries_hash TEXT;
+
+-- feed items whose feed had no content for them, waiting for the
+-- article to be downloaded from its url (see backfill.py)
+CREATE TABLE IF NOT EXISTS content_fetch_queue (
+    feed_item_id INTEGER PRIMARY KEY,
+    url VARCHAR NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (feed_item_id) REFERENCES feed_items(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_content_fetch_queue_next_attempt
+    ON content_fetch_queue(next_attempt_at);
+
+-- outcome of the last download of each article url
+CREATE TABLE IF NOT EXISTS url_fetch_cache (
+    url VARCHAR PRIMARY KEY,
+    status INTEGER NOT NULL,
+    content TEXT,
+    fetched_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- failing feeds are retried with an exponential backoff instead of being
+-- paused right away: retry_after is when a feed that failed its last
+-- check (error_streak in a row) is tried again, NULL once it recovers.
+-- Only feeds failing for DEAD_ERROR_STREAK checks (see scheduler.py) or
+-- answering 410 Gone get processing_status_id = 2
+ALTER TABLE feeds ADD COLUMN retry_after DATETIME;
+
+-- feeds being processed: which process-feeds worker claimed them and
+-- until when, so several workers can share the database without
+-- processing the same feed twice (see claim_feeds_for_processing)
+ALTER TABLE feeds ADD COLUMN claimed_by TEXT;
+ALTER TABLE feeds ADD COLUMN claimed_until DATETIME;
+
+-- when the crawler last got a feed's domain, kept along feed_crawls (the
+-- history) so crawl-feeds picks the stalest feeds from an index instead
+-- of aggregating the whole history (see get_stalest_feeds)
+ALTER TABLE feeds ADD COLUMN last_crawled_at DATETIME;
+UPDATE feeds SET last_crawled_at = (
+    SELECT MAX(crawled_at) FROM feed_crawls WHERE feed_id = feeds.id
+);
+CREATE INDEX IF NOT EXISTS idx_feeds_status_last_crawled_at
+    ON feeds(status_id, last_crawled_at);
+
+-- values derived from other tables, updated along with them instead of
+-- computed on every page view (see get_latest_feed_items_count and
+-- get_latest_feed_items_refreshed_at)
+CREATE TABLE IF NOT EXISTS site_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT INTO site_stats (name, value)
+    SELECT 'latest_feed_items', COUNT(*) FROM latest_feed_items;
+INSERT INTO site_stats (name, value)
+    SELECT 'latest_feed_items_refreshed_at', CAST(STRFTIME('%s', last_refreshed) AS INTEGER)
+    FROM (SELECT MAX(last_refreshed) AS last_refreshed FROM latest_feed_items)
+    WHERE last_refreshed IS NOT NULL;
+
+-- full text search over posts (see search_feed_items). External content:
+-- the text stays in feed_items, the triggers keep the index in sync with
+-- every write to it (process-feeds inserts, backfill-content updates)
+CREATE VIRTUAL TABLE IF NOT EXISTS feed_items_fts USING fts5(
+    title,
+    content,
+    content='feed_items',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS feed_items_fts_insert AFTER INSERT ON feed_items
+BEGIN
+    INSERT INTO feed_items_fts (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS feed_items_fts_delete AFTER DELETE ON feed_items
+BEGIN
+    INSERT INTO feed_items_fts (feed_items_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+END;
+CREATE TRIGGER IF NOT EXISTS feed_items_fts_update
+AFTER UPDATE OF title, content ON feed_items
+BEGIN
+    INSERT INTO feed_items_fts (feed_items_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    INSERT INTO feed_items_fts (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+END;
+INSERT INTO feed_items_fts (feed_items_fts) VALUES ('rebuild');
+
+-- why a feed has its current status (the descr of its latest
+-- feed_status_history row) and since when, kept by insert_feed_history so
+-- reports on blocked feeds don't search the history of every feed
+ALTER TABLE feeds ADD COLUMN status_reason TEXT;
+ALTER TABLE feeds ADD COLUMN status_changed_at DATETIME;
+CREATE INDEX IF NOT EXISTS idx_feed_status_history_feed_created_at
+    ON feed_status_history(feed_id, created_at);
+UPDATE feeds SET (status_reason, status_changed_at) = (
+    SELECT descr, created_at FROM feed_status_history
+    WHERE feed_id = feeds.id
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+);
+CREATE INDEX IF NOT EXISTS idx_feeds_status_reason
+    ON feeds(status_id, status_reason, status_changed_at DESC);
+
+-- feed_items.content and url_fetch_cache.content are compressed (see
+-- compression.py), with one of these dictionaries when it names one.
+-- Rows are never changed or deleted
+CREATE TABLE IF NOT EXISTS content_dictionaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data BLOB NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- the search index reads post text through decompress_content, an sql
+-- function defined by db.connect, so it isn't kept in sync by triggers
+-- (writes to feed_items from the sqlite3 shell would fail): db.py updates
+-- it along with its own writes, see SEARCH_INDEX_ADD. After changing
+-- posts from the shell, or after this part on an existing database, run
+-- `flask rebuild-search-index`
+DROP TRIGGER IF EXISTS feed_items_fts_insert;
+DROP TRIGGER IF EXISTS feed_items_fts_delete;
+DROP TRIGGER IF EXISTS feed_items_fts_update;
+DROP TABLE IF EXISTS feed_items_fts;
+CREATE VIEW IF NOT EXISTS feed_items_text AS
+    SELECT id, title, decompress_content(content) AS content FROM feed_items;
+CREATE VIRTUAL TABLE IF NOT EXISTS feed_items_fts USING fts5(
+    title,
+    content,
+    content='feed_items_text',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);